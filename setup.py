@@ -3,7 +3,7 @@ from setuptools import setup
 version = '1.0.0'
 
 setup(name='tinybot',
-      packages=['tinybot'],
+      packages=['tinybot', 'tinybot.bench'],
       version=version,
       description='Very simple yet flexible Telegram Bot API',
       long_description=open('readme.markdown').read(),
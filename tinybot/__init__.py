@@ -1,55 +1,108 @@
+import asyncio
+import os
 from asyncio import iscoroutinefunction
+from contextlib import AsyncExitStack, contextmanager, asynccontextmanager
+from time import monotonic, perf_counter
 from inspect import signature
+from pathlib import PurePath
 from traceback import print_exc
+from urllib.parse import urlparse
 
-from aiohttp import ClientSession
+from aiohttp import ClientError
 
 import tinybot.logger as tlogger
+from tinybot.broadcaster import *
+from tinybot.coalesce import *
+from tinybot.dispatch import *
+from tinybot.executor import *
+from tinybot.filecache import *
+from tinybot.journal import *
+from tinybot.metrics import *
+from tinybot.profiling import *
+from tinybot.ratelimit import *
+from tinybot.responsecache import *
+from tinybot.router import *
 from tinybot.runner import *
+from tinybot.session import *
+from tinybot.state import *
 from tinybot.webapi import *
+from tinybot.webhook import *
+from tinybot.workers import *
 
-__all__ = ('Bot', 'run', 'debug_run')
+__all__ = ('Bot', 'Host', 'run', 'debug_run')
 
 logger = tlogger.get('tinybot')
 
+# seconds between the getUpdates retries after network errors are doubled up to this
+MAX_POLL_BACKOFF = 60
 
-def setup_handlers(cls, api):
+
+def update_types(cls):
+    """Returns the names of the update types the bot class has handlers or routes for"""
+    types = {k[7:] for k in dir(cls) if k.startswith('handle_')}
+    types.update(cls.router.update_types)
+    if cls.response_cache:
+        types.update(ResponseCache.invalidating_updates)
+    return sorted(types)
+
+
+def setup_handlers(cls, api, runner):
     handlers = {}
     instance = cls()
+    router = cls.router
+    router.username = cls.username
 
-    loop = asyncio.get_event_loop()
-    blocking_api = BlockingTelegramAPI(api, loop)
+    def create_handler(f):
+        try:
+            param_name = list(signature(f).parameters)[0]
+        except ValueError:
+            param_name = '<root>'
 
-    for k in dir(cls):
-        if not k.startswith('handle_'):
-            continue
+        if iscoroutinefunction(f):
+            return lambda d, *args: f(d.with_root(param_name), api, *args)
 
-        name = k[7:]
-        func = getattr(instance, f'handle_{name}', None)
+        async def asynced(d, *args):
+            return await runner.run(f, param_name, d, *args)
 
-        if func is None:
-            logger.warning('received an update for \'%s\' update, but no handler exists for it', name)
-            continue
+        return asynced
 
-        def create_handler(f):
-            try:
-                param_name = list(signature(f).parameters)[0]
-            except ValueError:
-                param_name = '<root>'
+    routes = {name: create_handler(getattr(instance, name)) for name in router.methods}
 
-            if iscoroutinefunction(f):
-                return lambda d: f(d.with_root(param_name), api)
+    def create_routed_handler(update_type, fallback):
+        async def routed(d):
+            target = router.route(update_type, d)
+            if target is not None:
+                name, args = target
+                return await routes[name](d, *args)
+            if fallback is not None:
+                return await fallback(d)
+
+        return routed
+
+    for name in update_types(cls):
+        func = getattr(instance, f'handle_{name}', None)
+        handler = create_handler(func) if func is not None else None
 
-            async def asynced(d):
-                return await loop.run_in_executor(None, lambda: f(d.with_root(param_name), blocking_api))
+        if name in router.update_types:
+            handler = create_routed_handler(name, handler)
 
-            return asynced
+        if handler is None and name in ResponseCache.invalidating_updates and cls.response_cache:
+            # those are received only to keep the response cache fresh
+            handler = ignore_update
 
-        handlers[name] = create_handler(func)
+        if handler is None:
+            logger.warning('received an update for \'%s\' update, but no handler exists for it', name)
+            continue
+
+        handlers[name] = handler
     return handlers
 
 
-async def handle_update(handlers, update):
+async def ignore_update(data):
+    pass
+
+
+async def handle_update(handlers, update, metrics=None, profiler=None):
     for name, data in update.items():
         if name == 'update_id':
             continue
@@ -57,12 +110,16 @@ async def handle_update(handlers, update):
         handler = handlers.get(name)
         if not handler:
             logger.warning('received an update for \'%s\' update, but no handler exists for it', name)
+            continue
 
+        start = perf_counter()
+        failed = True
         # noinspection PyBroadException
         try:
             logger.debug('received \'%s\' update %s', name, data)
 
             await handler(data)
+            failed = False
 
             logger.debug('handled \'%s\' update successfully', name)
 
@@ -74,9 +131,169 @@ async def handle_update(handlers, update):
             logger.error('unchecked exception while handling \'%s\' update:', name)
             print_exc()
 
-
-def create_session(cls):
-    return ClientSession(headers={'User-Agent': cls.full_name, 'Accept': 'application/json'})
+        elapsed = perf_counter() - start
+        if metrics is not None:
+            metrics.observe_handler(name, elapsed, failed)
+        if profiler is not None and profiler.active:
+            profiler.observe(name, update, elapsed)
+
+
+def create_api(cls, session):
+    limiter = RateLimiter(*cls.rate_limits) if cls.rate_limits else None
+    file_cache = FileIdCache(cls.file_cache_size, cls.file_cache_path) if cls.file_cache_size else None
+    response_cache = None
+    if cls.response_cache:
+        ttls = cls.response_cache if isinstance(cls.response_cache, dict) else None
+        response_cache = ResponseCache(ttls, cls.response_cache_size)
+    return TelegramAPI(session, cls.token, limiter, cls.codec, file_cache, cls.api_url, cls.metrics, response_cache)
+
+
+def create_dispatcher(cls, handlers, journal=None, response_cache=None):
+    metrics, profiler = cls.metrics, cls.profiler
+    if journal is None and response_cache is None:
+        def dispatch(update):
+            return handle_update(handlers, update, metrics, profiler)
+    else:
+        async def dispatch(update):
+            if response_cache is not None:
+                response_cache.invalidate_for(update)
+            await handle_update(handlers, update, metrics, profiler)
+            if journal is not None:
+                journal.done(update.update_id)
+
+    if cls.shards:
+        return ShardedDispatcher(dispatch, cls.shards, cls.max_in_flight, metrics)
+    return Scheduler(dispatch, cls.max_in_flight, metrics)
+
+
+def create_coalescer(cls, dispatcher, api, journal=None):
+    """Wraps the dispatcher in a Coalescer when any of its policies are enabled"""
+    if cls.dedup_updates is None and cls.coalesce_edits is None and cls.debounce_callbacks is None:
+        return dispatcher
+
+    def on_drop(update, policy):
+        # dropped updates are done with as much as the handled ones
+        if journal is not None:
+            journal.done(update.update_id)
+        if policy == 'callback':
+            asyncio.ensure_future(answer_dropped_query(api, update.callback_query.id))
+
+    return Coalescer(dispatcher, cls.dedup_updates, cls.coalesce_edits, cls.debounce_callbacks,
+                     on_drop, cls.metrics)
+
+
+async def answer_dropped_query(api, query_id):
+    """Answers a dropped callback query, so that its button stops showing the progress"""
+    # noinspection PyBroadException
+    try:
+        await api.answerCallbackQuery(callback_query_id=query_id)
+    except RequestError as e:
+        logger.debug('failed to answer a dropped callback query, %s', e.args[0])
+    except Exception as e:
+        logger.debug('failed to answer a dropped callback query, %r', e)
+
+
+def create_state_store(cls):
+    backend = cls.state_backend
+    if isinstance(backend, (str, PurePath)):
+        backend = SQLiteBackend(backend)
+    return StateStore(backend, cls.state_cache_size, cls.codec)
+
+
+def create_runner(cls, api):
+    loop = asyncio.get_event_loop()
+    if cls.executor == 'process':
+        return ProcessRunner(api, loop, cls.executor_workers)
+    if cls.executor == 'thread':
+        return ThreadRunner(api, loop, cls.executor_workers, cls.deferred_calls)
+    raise ValueError('unknown executor \'%s\', expected \'thread\' or \'process\'' % cls.executor)
+
+
+@contextmanager
+def launched(cls, session, journal=None):
+    """Sets up everything needed to handle the updates, yields the api, the handlers and the dispatcher"""
+    api = create_api(cls, session)
+    runner = create_runner(cls, api)
+    store = None
+    try:
+        if cls.state_backend is not None:
+            store = cls.state_store = create_state_store(cls)
+        handlers = setup_handlers(cls, api, runner)
+        dispatcher = create_dispatcher(cls, handlers, journal, api.response_cache)
+        dispatcher = cls.dispatcher = create_coalescer(cls, dispatcher, api, journal)
+
+        metrics = cls.metrics
+        metrics.gauge('tinybot_updates_in_flight', lambda: dispatcher.in_flight, 'Updates being handled')
+        metrics.gauge('tinybot_updates_queued', lambda: dispatcher.queue_depth, 'Updates waiting in the dispatcher')
+        metrics.gauge('tinybot_executor_pending', lambda: runner.pending,
+                      'Sync handler calls submitted to the executor and not finished')
+        metrics.gauge('tinybot_executor_queue_depth', lambda: runner.queue_depth,
+                      'Sync handler calls waiting for a free executor worker')
+        if isinstance(dispatcher, Coalescer):
+            metrics.gauge('tinybot_updates_held', lambda: dispatcher.held, 'Edits held back waiting for newer ones')
+        flusher = None
+        if store is not None:
+            metrics.gauge('tinybot_states_dirty', lambda: store.dirty, 'Changed chat states not written yet')
+            flusher = asyncio.ensure_future(store.run(cls.state_flush_interval))
+        profiler = cls.profiler
+        if cls.log_slow_updates:
+            profiler.start_slow_log(cls.slow_update_threshold)
+        if cls.profile_signals:
+            watch_signals(profiler, cls.profile_updates, cls.slow_update_threshold)
+        metrics_server = None
+        if cls.metrics_port:
+            metrics_server = asyncio.ensure_future(serve_metrics(metrics, cls.metrics_port, profiler,
+                                                                 cls.profile_token))
+        try:
+            yield api, handlers, dispatcher
+        finally:
+            dispatcher.close()
+            if flusher is not None:
+                flusher.cancel()
+            if metrics_server is not None:
+                metrics_server.cancel()
+            if cls.profile_signals:
+                unwatch_signals(profiler)
+            profiler.close()
+    finally:
+        runner.shutdown()
+        # the states changed by the handlers which finished are written before exiting
+        if store is not None:
+            store.close()
+        if api.file_cache is not None:
+            api.file_cache.save()
+
+
+def setup_webhook_ssl(cls, url):
+    """
+    Returns the SSL context of the webhook server as configured by the `webhook_ssl` of given bot class (or host),
+    the path of the self-signed certificate to be uploaded with the webhook, and whether it was just made.
+    The context is None when the webhook is served over plain HTTP, the path is None when there is nothing to upload
+    """
+    if not cls.webhook_ssl:
+        return None, None, False
+    if cls.webhook_ssl != 'self-signed':
+        cert_path, key_path = cls.webhook_ssl
+        return create_ssl_context(cert_path, key_path), None, False
+    if url is None:
+        raise ValueError('webhook url is needed to make a self-signed certificate for its host')
+    # imported here as cryptography is only needed for self-signed certificates
+    from tinybot.gencert import load_or_create
+    cert_path, key_path, created = load_or_create(urlparse(url).hostname, cls.webhook_cert_dir)
+    return create_ssl_context(cert_path, key_path), cert_path, created
+
+
+def serve_webhook_worker(index, cls, url, local_port, workers):
+    """Runs one of the forked webhook server processes, the global rate limit is split between them"""
+    if cls.rate_limits:
+        global_rate, *rest = cls.rate_limits
+        cls.rate_limits = (global_rate / workers, *rest)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(cls.serve_webhook(url, local_port, reuse_port=True, set_webhook=False))
+    except KeyboardInterrupt:
+        pass
 
 
 class Bot:
@@ -118,55 +335,483 @@ class Bot:
     token = None
     """Token to be used by this bot, usually not set directly in class definition"""
 
+    username = None
+    """
+    Username of the bot without the '@'. When set, commands addressed to other bots
+    as '/command@other_bot' are not routed to the methods decorated with `command`
+    """
+
+    connection_limit = 100
+    """Maximum number of connections to Telegram the handlers can use at the same time"""
+
+    keepalive_timeout = 60
+    """Seconds an idle connection is kept open for the next request, so bursts do not pay for new TLS handshakes"""
+
+    dns_cache_ttl = 300
+    """Seconds the resolved Telegram API address is cached for"""
+
+    connection_stats = None
+    """ConnectionStats of the bot sessions, counting the connections made and reused"""
+
+    api_url = None
+    """Base url of the Bot API server, e.g. of a local one, defaults to the Telegram one"""
+
+    rate_limits = (30, 1, 20 / 60)
+    """
+    Messages per second allowed globally, to a single private chat and to a single group or channel.
+    Messages over these limits are delayed, set to None to disable the limiting.
+    Only the methods sending messages are limited, see `tinybot.ratelimit.RateLimiter.limits`
+    """
+
+    codec = None
+    """
+    JSON codec used for requests, responses and webhook bodies, one of those in `tinybot.codec`.
+    Defaults to the fastest one installed (orjson, then ujson, then the standard json module)
+    """
+
+    file_cache_size = 1024
+    """
+    Number of file_ids of the sent files remembered, so that sending the same
+    content again sends it by reference instead of uploading it. Set to 0 to disable
+    """
+
+    file_cache_path = None
+    """Optional path of a file where the file_id cache is kept between restarts"""
+
+    journal = None
+    """
+    Path of the update journal used in longpoll mode. When set, received updates are recorded
+    before they are acknowledged, and the ones which were not handled before a crash
+    or a restart are handled on the next start
+    """
+
+    journal_compact = True
+    """Whether handled updates are dropped from the journal, turn off to record updates for `launch_replay`"""
+
+    response_cache = False
+    """
+    Whether the results of the methods which only read, such as getChatMember, are cached,
+    see `tinybot.responsecache.ResponseCache`. True caches them for the default times,
+    or it can be a dict of the cached method names to the seconds their results are kept for.
+    When enabled, chat_member and my_chat_member updates are received to keep the cache fresh
+    """
+
+    response_cache_size = 1024
+    """Maximum number of cached results"""
+
+    webhook_max_connections = 40
+    """Maximum number of connections Telegram makes to deliver updates to the webhook, at most 100"""
+
+    webhook_admission_timeout = 5
+    """
+    Seconds a webhook request waits for the dispatcher to have a free slot when it is saturated,
+    after which the update is answered with 503 so that Telegram delivers it again later.
+    Keeps the number of queued updates bounded during floods, set to None to accept all of the updates
+    """
+
+    webhook_adaptive = False
+    """
+    Whether the max_connections of the webhook is adjusted to the load, lowered when updates are
+    rejected or handlers are slow and raised back when Telegram has updates pending.
+    Only when the webhook is set by the serving process, that is, not with multiple workers
+    """
+
+    webhook_latency_target = 1.0
+    """Mean handler latency in seconds above which `webhook_adaptive` lowers max_connections"""
+
+    webhook_adjust_interval = 30
+    """Seconds between the adjustments of `webhook_adaptive`"""
+
+    webhook_ssl = None
+    """
+    How the webhook server does TLS: None serves plain HTTP, for when there is a TLS proxy in front of it.
+    'self-signed' makes a certificate for the host of the webhook url, caches it in `webhook_cert_dir`
+    and uploads it to Telegram with the webhook. A (certificate path, key path) pair serves
+    a certificate signed by a known CA, which is not uploaded
+    """
+
+    webhook_cert_dir = 'certs'
+    """Directory where self-signed webhook certificates are kept, see `tinybot.gencert.load_or_create`"""
+
+    dedup_updates = None
+    """
+    If set, this many of the most recent update_ids are remembered and the updates repeating them
+    are dropped, e.g. the ones Telegram delivered to the webhook again after a timeout.
+    This and the two below are the policies of `tinybot.coalesce.Coalescer`, their drops are counted
+    in `metrics` as tinybot_updates_dropped_total
+    """
+
+    coalesce_edits = None
+    """
+    If set, edited messages and channel posts are held for this many seconds, and only the newest edit
+    of a message received during that time is handled
+    """
+
+    debounce_callbacks = None
+    """
+    If set, callback queries with the same data from the same user are dropped for this many seconds
+    after the one which was handled. The dropped ones are answered with no text
+    """
+
+    state_backend = None
+    """
+    Where the per-chat states given by `state` are kept: a path of a SQLite database, or a backend object
+    with the interface of `tinybot.state.SQLiteBackend`. States are not available when it is None
+    """
+
+    state_cache_size = 10000
+    """Maximum number of chat states kept in memory, the least recently used ones are loaded again when needed"""
+
+    state_flush_interval = 1
+    """Seconds between the writes of the changed chat states, they are also written when the bot stops"""
+
+    state_store = None
+    """The `tinybot.state.StateStore` of the running bot, set by the `launch_xxx` methods"""
+
+    max_in_flight = 100
+    """
+    Maximum number of updates handled at the same time, the rest wait in a queue.
+    While the queue is not empty, the longpoll loop does not fetch new updates
+    """
+
+    shards = None
+    """
+    If set, updates are spread by their chat (or user, when there is no chat)
+    over this many worker queues, so that updates from the same chat are handled
+    in order while different chats are still handled in parallel.
+    In this mode `max_in_flight` limits the number of queued updates
+    """
+
+    executor = 'thread'
+    """
+    How sync (non-coroutine) handlers are run: 'thread' runs them in a dedicated thread pool,
+    'process' runs them in a process pool so that CPU-bound handlers can use all of the cores.
+    In process mode the API calls are made by the main process, see `tinybot.executor.ProcessRunner`
+    """
+
+    executor_workers = None
+    """Number of threads or processes for sync handlers, defaults to the executor default"""
+
+    deferred_calls = False
+    """
+    If True, the API calls of sync handlers in the thread executor return futures right away,
+    so that independent calls are made at the same time, and they are all waited for after the handler returns.
+    With 'detach' they are not waited for, errors are only logged. See `BlockingTelegramAPI.deferred`,
+    which can also be used for a part of a handler. Not supported by the process executor
+    """
+
+    dispatcher = None
+    """
+    Dispatcher of the running bot, set by the `launch_xxx` methods.
+    Its `in_flight` and `queue_depth` properties tell how loaded the bot is
+    """
+
+    router = None
+    """
+    Routes of the bot compiled from its methods decorated with `tinybot.command`, `prefix`, `regex` and `callback`.
+    Routed methods have the same signature as `handle_xxx` ones, plus an optional extra argument (see the decorators).
+    Messages and callback queries with no route go to `handle_message` and `handle_callback_query`, if they exist
+    """
+
+    metrics = None
+    """
+    Metrics of the bot, a `tinybot.metrics.Metrics` made for each bot class:
+    handler, API call and queue wait latencies, error and retry counters and the load of the dispatcher.
+    Read them with `metrics.stats`, or render them for Prometheus with `metrics.render()`
+    """
+
+    metrics_port = None
+    """
+    If set, the metrics are served in Prometheus text format at '/metrics' on this port,
+    along with the endpoints controlling the profiler (see `tinybot.metrics.serve_metrics`),
+    which only answer to requests from localhost unless `profile_token` is set
+    """
+
+    profile_token = None
+    """
+    If set, the profiler endpoints of the metrics port also answer to requests from other hosts
+    with an 'Authorization: Bearer <profile_token>' header
+    """
+
+    profiler = None
+    """
+    The `tinybot.profiling.Profiler` made for each bot class, which profiles the next n updates or logs the slow ones
+    when switched on at runtime: with `profile_signals`, through the metrics port, or by calling its methods
+    """
+
+    profile_dir = 'profiles'
+    """Directory the profiles and the slow update logs are written to"""
+
+    profile_updates = 1000
+    """Number of updates profiled when profiling is started by a signal"""
+
+    slow_update_threshold = 1.0
+    """Handler time in seconds above which updates are logged as slow"""
+
+    log_slow_updates = False
+    """Whether slow updates are logged from the start"""
+
+    profile_signals = False
+    """
+    Whether SIGUSR1 starts profiling the next `profile_updates` updates (or stops it and writes the profile),
+    and SIGUSR2 toggles logging the slow updates
+    """
+
+    def state(self, chat_id):
+        """
+        Returns the state of the chat with given id, a dict kept between the updates and the restarts,
+        see `tinybot.state.State` for what counts as a change of it. Needs `state_backend` to be set,
+        and is not available to the sync handlers run by the process executor
+        """
+        store = self.state_store
+        if store is None:
+            raise RuntimeError('%s has no state store, set its state_backend and use the thread executor' % self.name)
+        return store.get(chat_id)
+
     def __init_subclass__(cls, **kwargs):
         cls.name = cls.name or cls.__name__
         cls.full_name = cls.name + '/' + cls.version
+        cls.connection_stats = ConnectionStats()
+        cls.metrics = Metrics(cls.name)
+        cls.profiler = Profiler(cls.name, cls.profile_dir)
+        cls.router = Router(cls)
 
     @classmethod
-    async def update_webhook(cls, api, url, allowed_updates, max_connections=40):
-        """Overridable if for whatever reason Telegram API for webhooks changes"""
+    async def update_webhook(cls, api, url, allowed_updates, max_connections=None, certificate=None, force=False):
+        """
+        Overridable if for whatever reason Telegram API for webhooks changes.
+        The self-signed `certificate` at given path is uploaded with the webhook, which is set again
+        if Telegram has no certificate for it, or if `force` is set, e.g. because the certificate was renewed
+        """
+        if max_connections is None:
+            max_connections = cls.webhook_max_connections
         url = url + '/' + cls.token
         logger.info('getting webhook info')
         info = await api.getWebhookInfo()
-        if info.url != url \
+        if force or info.url != url \
                 or set(info.allowed_updates) != set(allowed_updates) \
-                or info.get('max_connections') != max_connections:
+                or info.get('max_connections') != max_connections \
+                or certificate is not None and not info.get('has_custom_certificate'):
             logger.info('setting webhook url to %s, and allowed updates to %s', url, allowed_updates)
-            await api.setWebhook(url=url, allowed_updates=allowed_updates, max_connections=max_connections)
+            kwargs = {}
+            if certificate is not None:
+                # paths are uploaded as files
+                kwargs['certificate'] = PurePath(certificate)
+            await api.setWebhook(url=url, allowed_updates=allowed_updates, max_connections=max_connections, **kwargs)
         else:
             logger.info('webhook is correct')
 
     @classmethod
-    def launch_longpoll(cls, timeout):
-        """Starts the longpoll loop with given timeout"""
-        logger.info('starting longpoll loop with %s second timeout', timeout)
+    async def serve_longpoll(cls, timeout):
+        """Coroutine which runs the longpoll loop with given timeout until cancelled"""
+        # getUpdates has its own connection, so the handlers never wait for a free one behind it
+        async with create_session(cls) as session, create_session(cls, 1, timeout + 30) as poll_session:
+            await cls.poll(timeout, session, poll_session)
 
-        async def go():
-            async with create_session(cls) as session:
-                api = TelegramAPI(session, cls.token)
-                handlers = setup_handlers(cls, api)
+    @classmethod
+    async def poll(cls, timeout, session, poll_session):
+        """
+        Coroutine which runs the longpoll loop with given timeout until cancelled, making the calls
+        of the handlers with `session` and the getUpdates calls with `poll_session`
+        """
+        journal = Journal(cls.journal, cls.codec, cls.journal_compact) if cls.journal else None
+        try:
+            with launched(cls, session, journal) as (api, handlers, dispatcher):
+                poll_api = TelegramAPI(poll_session, cls.token, codec=api.codec, api_url=api.api_url,
+                                       metrics=cls.metrics)
                 callbacks = list(handlers.keys())
                 last_id = -1
-                tasks = []
+                failures = 0
+
+                if journal is not None:
+                    for update in journal.recover():
+                        dispatcher.submit(DynamicDictObject(update))
+                    last_id = journal.last_id
 
                 while True:
-                    for update in await api.getUpdates(offset=last_id + 1, allowed_updates=callbacks, timeout=timeout):
-                        tasks.append(asyncio.ensure_future(handle_update(handlers, update)))
+                    if dispatcher.saturated:
+                        logger.debug('%s updates in flight and %s queued, delaying getUpdates',
+                                     dispatcher.in_flight, dispatcher.queue_depth)
+                        await dispatcher.wait_ready()
+
+                    try:
+                        updates = await poll_api.getUpdates(offset=last_id + 1, allowed_updates=callbacks,
+                                                            timeout=timeout)
+                    except (RequestError, ClientError, asyncio.TimeoutError) as e:
+                        # network errors and such should not stop the bot, the rest are raised
+                        if classify_error(e) != 'retry':
+                            raise
+                        failures += 1
+                        delay = e.retry_after if isinstance(e, RequestError) and e.retry_after \
+                            else min(2 ** failures, MAX_POLL_BACKOFF)
+                        logger.warning('getUpdates of %s failed, %r, retrying in %s seconds', cls.name, e, delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    failures = 0
+
+                    # the updates are acknowledged by the next getUpdates, they must be on disk by then
+                    if journal is not None and updates.unwrap():
+                        for update in updates:
+                            journal.received(update.unwrap())
+                        await journal.sync()
+
+                    batch = 0
+                    for update in updates:
+                        dispatcher.submit(update)
                         last_id = update.update_id
+                        batch += 1
+                    cls.metrics.observe_batch(batch)
+        finally:
+            if journal is not None:
+                journal.close()
 
-                    while len(tasks) > 100:
-                        await tasks[0]
-
+    @classmethod
+    def launch_longpoll(cls, timeout):
+        """Starts the longpoll loop with given timeout"""
+        logger.info('starting longpoll loop with %s second timeout', timeout)
         try:
-            asyncio.get_event_loop().run_until_complete(go())
+            asyncio.get_event_loop().run_until_complete(cls.serve_longpoll(timeout))
         except KeyboardInterrupt:
             logger.info('stopped longpoll loop due to interrupt signal')
 
     @classmethod
-    def launch_webhook(cls, url, local_port=None):
+    async def serve_replay(cls, path):
+        """
+        Coroutine which feeds all of the updates recorded in the journal at given path
+        through the handlers as fast as they are handled. Returns the number of updates
+        """
+        async with create_session(cls) as session:
+            with launched(cls, session) as (api, handlers, dispatcher):
+                count, start = 0, monotonic()
+                for update in Journal.updates(path, api.codec):
+                    if dispatcher.saturated:
+                        await dispatcher.wait_ready()
+                    dispatcher.submit(DynamicDictObject(update))
+                    count += 1
+                await dispatcher.join()
+                logger.info('replayed %s updates in %.3f seconds', count, monotonic() - start)
+                return count
+
+    @classmethod
+    def launch_replay(cls, path):
+        """Replays the updates recorded in the journal at given path, see `serve_replay`"""
+        logger.info('replaying updates from %s', path)
+        try:
+            return asyncio.get_event_loop().run_until_complete(cls.serve_replay(path))
+        except KeyboardInterrupt:
+            logger.info('stopped replay due to interrupt signal')
+
+    @classmethod
+    async def serve_broadcast(cls, method, targets, **kwargs):
+        """
+        Coroutine which calls given method for each of the targets with the API of this bot,
+        without handling any updates. The kwargs are the ones of `tinybot.broadcaster.broadcast`. Returns the stats
+        """
+        async with create_session(cls) as session:
+            api = create_api(cls, session)
+            try:
+                return await broadcast(api, method, targets, **kwargs)
+            finally:
+                if api.file_cache is not None:
+                    api.file_cache.save()
+
+    @classmethod
+    def launch_broadcast(cls, method, targets, **kwargs):
+        """
+        Runs a broadcast, see `serve_broadcast`. With a checkpoint given, it can be interrupted
+        and launched again to continue it
+        """
+        logger.info('starting broadcast of %s', method)
+        try:
+            return asyncio.get_event_loop().run_until_complete(cls.serve_broadcast(method, targets, **kwargs))
+        except KeyboardInterrupt:
+            logger.info('stopped broadcast due to interrupt signal')
+
+    @classmethod
+    async def serve_webhook(cls, url, local_port, reuse_port=False, set_webhook=True):
+        """
+        Coroutine which sets the webhook (if url is not None and `set_webhook` is true) and then serves
+        the webhook server at given local port until cancelled, over HTTPS if `webhook_ssl` is set
+        """
+        ssl_context, certificate, renewed = setup_webhook_ssl(cls, url)
+        async with create_session(cls) as session, \
+                cls.webhook_handler(session, url if set_webhook else None, certificate, renewed) as handler:
+            await serve_app(create_webhook_app({cls.token: handler}), local_port, reuse_port, ssl_context)
+
+    @classmethod
+    @asynccontextmanager
+    async def webhook_handler(cls, session, url=None, certificate=None, renewed=False):
+        """
+        Sets up the bot to make its calls with given session and sets the webhook (if url is not None)
+        with given certificate (see `update_webhook`), yields the aiohttp handler of the update requests
+        from Telegram, see `create_webhook_app`
+        """
+        with launched(cls, session) as (api, handlers, dispatcher):
+            allowed_updates = list(handlers.keys())
+            if url is not None:
+                await cls.update_webhook(api, url, allowed_updates, certificate=certificate, force=renewed)
+
+            admission = None
+            if cls.webhook_admission_timeout is not None:
+                admission = AdmissionControl(dispatcher, cls.webhook_admission_timeout, cls.webhook_max_connections)
+
+            adjuster = None
+            if url is not None and admission is not None and cls.webhook_adaptive:
+                adjuster = asyncio.ensure_future(cls.adjust_webhook(api, url, allowed_updates, admission, certificate))
+            try:
+                yield create_update_handler(cls, dispatcher.submit, api.codec, admission)
+            finally:
+                if adjuster is not None:
+                    adjuster.cancel()
+
+    @classmethod
+    async def adjust_webhook(cls, api, url, allowed_updates, admission, certificate=None):
+        """
+        Coroutine which each `webhook_adjust_interval` seconds sets the max_connections of
+        the webhook to the one suggested by the admission control (see `AdmissionControl.adjust`)
+        from the rejected updates, the mean handler latency and the number of updates Telegram has pending
+        """
+        handler_latency = cls.metrics.handler_latency
+        last_sum, last_count = 0.0, 0
+        while True:
+            await asyncio.sleep(cls.webhook_adjust_interval)
+
+            total_sum = sum(h.sum for h in handler_latency.values())
+            total_count = sum(h.count for h in handler_latency.values())
+            latency = (total_sum - last_sum) / (total_count - last_count) if total_count > last_count else None
+            last_sum, last_count = total_sum, total_count
+
+            try:
+                info = await api.getWebhookInfo()
+                current = admission.max_connections
+                suggested = admission.adjust(latency, cls.webhook_latency_target, info.get('pending_update_count') or 0)
+                if suggested != current:
+                    logger.info('changing webhook max_connections from %s to %s', current, suggested)
+                    await cls.update_webhook(api, url, allowed_updates, suggested, certificate)
+            except RequestError as e:
+                logger.warning('failed to adjust webhook max_connections, %s', e.args[0])
+            except Exception as e:
+                logger.warning('failed to adjust webhook max_connections, %r', e)
+
+    @classmethod
+    async def set_webhook(cls, url):
+        """Coroutine which only sets the webhook, with its own short-lived session"""
+        _, certificate, renewed = setup_webhook_ssl(cls, url)
+        async with create_session(cls) as session:
+            await cls.update_webhook(create_api(cls, session), url, update_types(cls),
+                                     certificate=certificate, force=renewed)
+
+    @classmethod
+    def launch_webhook(cls, url, local_port=None, workers=1):
         """
-        Starts the webhook server (automatically setting the webhook data) with given host and port.
-        Note that host is used to set the webhook as well as to launch python's http server
+        Starts the webhook server (automatically setting the webhook data) with given url and port.
+        The server is run on the same event loop as the handlers, so it accepts
+        many concurrent connections from Telegram servers.
+
+        With more than one worker, that many processes are forked, each with its
+        own event loop and session, all listening at the same port (SO_REUSEPORT).
+        The webhook is set once by this process, which then restarts the workers which die.
+        A self-signed certificate is made (or loaded) before the workers are started, so they share it
         """
 
         # url is optional so shift args accordingly
@@ -174,45 +819,126 @@ class Bot:
             local_port = url
             url = None
 
-        import json
-        from http import HTTPStatus
-        from http.server import BaseHTTPRequestHandler, HTTPServer
+        try:
+            if workers > 1:
+                if url is not None:
+                    asyncio.get_event_loop().run_until_complete(cls.set_webhook(url))
+                logger.info('starting %s webhook server workers', workers)
+                supervise(serve_webhook_worker, workers, (cls, url, local_port, workers))
+            else:
+                asyncio.get_event_loop().run_until_complete(cls.serve_webhook(url, local_port))
+        except KeyboardInterrupt:
+            logger.info('stopped webhook server due to interrupt signal')
+
 
-        async def go():
-            async with create_session(cls) as session:
-                api = TelegramAPI(session, cls.token)
-                handlers = setup_handlers(cls, api)
+class Host:
+    """
+    Runs many bots on one event loop, with one connection pool for all of their
+    calls and, in webhook mode, one server at one port routing the updates
+    to the bots by the token in the path (as set by `Bot.update_webhook`).
+    In longpoll mode the getUpdates loops of all of the bots run concurrently,
+    each holding one connection of a separate pool while it waits.
 
-                if url is not None:
-                    await cls.update_webhook(api, url, list(handlers.keys()))
+    Each bot keeps its own configuration, rate limiter, dispatcher and metrics.
+    """
+
+    name = 'tinybot-host'
+    version = '0.1.0'
 
-                server_logger = tlogger.get('tinybot.webhook')
+    connection_limit = 100
+    """Maximum number of connections all of the hosted bots can use for their calls at the same time"""
 
-                class PostRequestHandler(BaseHTTPRequestHandler):
-                    server_version = cls.full_name
+    keepalive_timeout = 60
+    """Seconds an idle connection is kept open for the next request"""
 
-                    def do_POST(self):
-                        nonlocal cls
+    dns_cache_ttl = 300
+    """Seconds resolved addresses are cached for"""
 
-                        self.send_response(HTTPStatus.OK)
-                        self.end_headers()
+    webhook_ssl = None
+    """How the webhook server does TLS, see `Bot.webhook_ssl`. The ones of the hosted bots are not used"""
 
-                        if self.path[1:] != cls.token:
-                            logger.warning('received POST request most likely not from Telegram servers')
-                            return
+    webhook_cert_dir = 'certs'
+    """Directory where the self-signed webhook certificate is kept"""
 
-                        post_data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
-                        data = json.loads(str(post_data, encoding='utf-8'))
-                        handle_update(cls, DynamicDictObject(data))
+    def __init__(self, *bots):
+        """:param bots: bot classes to host, more can be added with `add`"""
+        self.full_name = self.name + '/' + self.version
+        self.connection_stats = ConnectionStats()
+        self.bots = []
+        for bot_cls in bots:
+            self.add(bot_cls)
 
-                    def log_message(self, fmt, *args):
-                        server_logger.debug(fmt, *args)
+    def add(self, bot_cls, token=None):
+        """
+        Adds a bot class to the host. With a token given, a subclass of the bot class with that
+        token is added instead, so that one class can be hosted many times with different tokens.
+        Its `journal`, `state_backend` and `file_cache_path` get the id of the bot inserted before
+        their extension, e.g. 'state.123456.db', as they can not be shared by the bots.
+        Note that such subclasses can not be used with the process executor,
+        as they can not be imported by the worker processes. Returns the added class
+        """
+        if token is not None:
+            bot_id = token.split(':')[0]
+            attrs = {'token': token, 'name': '%s:%s' % (bot_cls.name, bot_id)}
+            for attr in ('journal', 'state_backend', 'file_cache_path'):
+                path = getattr(bot_cls, attr)
+                if path is None:
+                    continue
+                if not isinstance(path, (str, PurePath)):
+                    raise ValueError('%s of %s is not a path, so it can not be made for each of its tokens'
+                                     % (attr, bot_cls.name))
+                root, extension = os.path.splitext(os.fspath(path))
+                attrs[attr] = '%s.%s%s' % (root, bot_id, extension)
+            bot_cls = type(bot_cls.__name__, (bot_cls,), attrs)
+        if any(b.token == bot_cls.token for b in self.bots):
+            raise ValueError('a bot with the token of %s is already hosted' % bot_cls.name)
+        self.bots.append(bot_cls)
+        return bot_cls
+
+    async def serve_longpoll(self, timeout):
+        """Coroutine which runs the longpoll loops of all of the bots with given timeout until cancelled"""
+        async with create_session(self) as session, \
+                create_session(self, len(self.bots), timeout + 30) as poll_session:
+            async def poll(bot_cls):
+                # noinspection PyBroadException
+                try:
+                    await bot_cls.poll(timeout, session, poll_session)
+                except Exception:
+                    logger.error('longpoll loop of %s stopped because of an exception:', bot_cls.name)
+                    print_exc()
+
+            await asyncio.gather(*(poll(bot_cls) for bot_cls in self.bots))
+
+    def launch_longpoll(self, timeout):
+        """Starts the longpoll loops of all of the bots with given timeout"""
+        logger.info('starting longpoll loops of %s bots with %s second timeout', len(self.bots), timeout)
+        try:
+            asyncio.get_event_loop().run_until_complete(self.serve_longpoll(timeout))
+        except KeyboardInterrupt:
+            logger.info('stopped longpoll loops due to interrupt signal')
+
+    async def serve_webhook(self, url, local_port):
+        """
+        Coroutine which sets the webhooks of all of the bots (if url is not None)
+        and then serves them at given local port until cancelled
+        """
+        ssl_context, certificate, renewed = setup_webhook_ssl(self, url)
+        async with create_session(self) as session, AsyncExitStack() as stack:
+            handlers = {}
+            for bot_cls in self.bots:
+                handlers[bot_cls.token] = await stack.enter_async_context(
+                    bot_cls.webhook_handler(session, url, certificate, renewed))
+            await serve_app(create_webhook_app(handlers), local_port, ssl_context=ssl_context)
+
+    def launch_webhook(self, url, local_port=None):
+        """Starts the webhook server of all of the bots with given url and port, see `Bot.launch_webhook`"""
 
-                logger.info('starting webhook server at port %s' % local_port)
-                server = HTTPServer(('', local_port), PostRequestHandler)
-                server.serve_forever()
+        # url is optional so shift args accordingly
+        if local_port is None:
+            local_port = url
+            url = None
 
         try:
-            asyncio.get_event_loop().run_until_complete(go())
+            asyncio.get_event_loop().run_until_complete(self.serve_webhook(url, local_port))
         except KeyboardInterrupt:
             logger.info('stopped webhook server due to interrupt signal')
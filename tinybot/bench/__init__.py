@@ -0,0 +1,3 @@
+"""
+Benchmarks for tinybot internals, each module is runnable with `python -m tinybot.bench.<name>`
+"""
@@ -0,0 +1,47 @@
+"""
+Measures the JSON encode/decode cost of a single update for each of the
+installed codecs, and its share in the per-update cost together with the
+field accesses of a typical handler.
+
+Run with `python -m tinybot.bench.codec`.
+"""
+from timeit import repeat
+
+from tinybot.bench.dynamic import UPDATE, handler
+from tinybot.codec import StdlibCodec, OrjsonCodec, UjsonCodec, orjson, ujson
+from tinybot.webapi import DynamicDictObject
+
+REPLY = {'chat_id': UPDATE['message']['chat']['id'], 'text': 'Hello there! ' * 4, 'reply_to_message_id': 42}
+
+
+def per_call(func, number=20000):
+    return min(repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    codecs = [StdlibCodec]
+    if ujson is not None:
+        codecs.append(UjsonCodec)
+    if orjson is not None:
+        codecs.append(OrjsonCodec)
+
+    update_body = StdlibCodec.dumps(UPDATE)
+    response_body = StdlibCodec.dumps({'ok': True, 'result': UPDATE['message']})
+    batch_body = StdlibCodec.dumps({'ok': True, 'result': [UPDATE] * 100})
+
+    handling = per_call(lambda: handler(DynamicDictObject(UPDATE).message.with_root('data')))
+
+    print(f'handler field access: {handling:.0f} ns per update')
+    print(f'{"codec":<8}{"update, ns":>12}{"reply, ns":>12}{"response, ns":>14}{"batch/100, ns":>15}{"share":>8}')
+    for codec in codecs:
+        decode_update = per_call(lambda: codec.loads(update_body))
+        encode_reply = per_call(lambda: codec.dumps(REPLY))
+        decode_response = per_call(lambda: codec.loads(response_body))
+        decode_batch = per_call(lambda: codec.loads(batch_body), 500) / 100
+        total = decode_update + encode_reply + decode_response
+        print(f'{codec.name:<8}{decode_update:>12.0f}{encode_reply:>12.0f}{decode_response:>14.0f}'
+              f'{decode_batch:>15.0f}{total / (total + handling):>8.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Compares the slotted, lazily pathed DynamicDictObject with its previous
+implementation on the field accesses a typical message handler does.
+
+Run with `python -m tinybot.bench.dynamic`.
+"""
+from timeit import repeat
+
+from tinybot.webapi import DynamicDictObject, NoSuchElementError, DynamicTypeError
+
+UPDATE = {
+    'update_id': 123456789,
+    'message': {
+        'message_id': 42,
+        'from': {'id': 1234567, 'is_bot': False, 'first_name': 'John', 'username': 'john'},
+        'chat': {'id': -1001234567890, 'title': 'Group', 'type': 'supergroup'},
+        'date': 1558000000,
+        'text': '/start hello there',
+        'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}],
+    },
+}
+
+
+class LegacyDynamicDictObject:
+    """The DynamicDictObject as it was before it got slots and lazy paths, kept for comparison"""
+
+    def __new__(cls, peer, path=''):
+        if not isinstance(peer, (dict, list)):
+            return peer
+        return super().__new__(cls)
+
+    def __init__(self, peer, path=''):
+        self.__peer, self.__path = peer, path
+
+    def with_root(self, path):
+        self.__path = '.' + path
+        return self
+
+    def items(self):
+        peer = self.__peer
+        if not isinstance(peer, dict):
+            raise DynamicTypeError(f'expected an object at {self.__path[1:]}, but it was '
+                                   f'\'{type(peer).__name__}\'')
+        return map(lambda k: (k, self[k]), peer)
+
+    def get(self, item):
+        try:
+            return self[item]
+        except NoSuchElementError:
+            return None
+
+    def __getattr__(self, item):
+        peer = self.__peer
+        if not isinstance(peer, dict):
+            raise DynamicTypeError(f'expected an object at \'{self.__path[1:]}\', but it was '
+                                   f'\'{type(peer).__name__}\'')
+        path = f'{self.__path}.{item}'
+        try:
+            child = peer[item]
+            # callables without arguments treated as properties
+            # and callables with arguments are prohibited
+            while callable(child):
+                child = child()
+        except (TypeError, KeyError):
+            raise NoSuchElementError(path[1:]) from None
+        return LegacyDynamicDictObject(child, path)
+
+    def __getitem__(self, item):
+        if isinstance(item, str) and item.isidentifier():
+            path = f'{self.__path}.{item}'
+        else:
+            path = f'{self.__path}[{repr(item)}]'
+        peer = self.__peer
+        try:
+            child = peer[item]
+        except TypeError:
+            raise DynamicTypeError(f'tried to index \'{type(peer).__name__}\' at {self.__path[1:]} with key of '
+                                   f'type \'{type(item).__name__}\'') from None
+        except (KeyError, IndexError):
+            raise NoSuchElementError(path[1:]) from None
+        return LegacyDynamicDictObject(child, path)
+
+    def __contains__(self, item):
+        if isinstance(self.__peer, dict):
+            return item in self.__peer
+        return False
+
+    def __iter__(self):
+        if isinstance(self.__peer, list):
+            path = self.__path
+            return map(lambda x: LegacyDynamicDictObject(x[1], f'{path}[{x[0]}]'), enumerate(self.__peer))
+
+        return iter(self.__peer)
+
+    def __repr__(self):
+        return repr(self.__peer)
+
+
+def handler(data):
+    """Field accesses of a typical message handler"""
+    chat_id = data.chat.id
+    user_id = data['from'].id
+    if data.chat.id == chat_id and data['from'].id == user_id:
+        text = data.text
+        for entity in data.entities:
+            if entity.type == 'bot_command':
+                text = text[entity.offset + entity.length:]
+        return 'reply_to_message' in data, data.get('caption'), text
+
+
+def missing(data):
+    """Access which ends with an error, so the path is built"""
+    try:
+        return data.reply_to_message.text
+    except NoSuchElementError:
+        return None
+
+
+def bench(cls, func, number=100000):
+    def run():
+        root = cls(UPDATE)
+        func(root.message.with_root('data'))
+
+    return min(repeat(run, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    print(f'{"case":<12}{"legacy, ns":>14}{"slotted, ns":>14}{"cached, ns":>14}')
+    default = DynamicDictObject.cache_children
+    for func in (handler, missing):
+        legacy = bench(LegacyDynamicDictObject, func)
+        DynamicDictObject.cache_children = False
+        uncached = bench(DynamicDictObject, func)
+        DynamicDictObject.cache_children = True
+        cached = bench(DynamicDictObject, func)
+        DynamicDictObject.cache_children = default
+        print(f'{func.__name__:<12}{legacy:>14.0f}{uncached:>14.0f}{cached:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""
+Local stand-in for the Telegram Bot API, so that bots can be benchmarked
+without a token and without the network.
+
+It serves `getUpdates` from a synthetic stream of message updates, or POSTs
+the same stream to the webhook set with `setWebhook` (trusting the certificate
+uploaded with it, if any, as Telegram does), and answers
+`sendMessage` and `sendDocument` after a configurable latency, rejecting
+some of them with 429 errors if asked to. Replies which have
+`reply_to_message_id` set are matched with their updates to measure the
+latency from the update being delivered to the reply being received.
+
+Besides the Bot API methods at '/bot<token>/<method>' it has two control endpoints:
+ - GET '/stats' returns the counters and the latency percentiles as JSON
+ - POST '/push' starts POSTing the updates to the webhook
+
+Run standalone with `python -m tinybot.bench.fakeapi`.
+"""
+import argparse
+import asyncio
+import json
+import ssl
+import time
+
+from aiohttp import web, ClientSession, ClientConnectionError, TCPConnector
+
+__all__ = ('FakeBotAPI', 'make_update', 'percentile')
+
+TOKEN = '123456:bench'
+
+
+def make_update(update_id, chats=100):
+    """Returns a private chat text message update, its message_id is the same as the update_id"""
+    chat_id = 1000000 + update_id % chats
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench', 'username': 'bench%s' % chat_id},
+            'chat': {'id': chat_id, 'first_name': 'Bench', 'username': 'bench%s' % chat_id, 'type': 'private'},
+            'date': 1558000000 + update_id,
+            'text': 'benchmark message number %s' % update_id,
+        },
+    }
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of given sorted values, None if there are none"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class FakeBotAPI:
+
+    def __init__(self, token=TOKEN, updates=10000, chats=100, latency=0.0, throttle_every=0, retry_after=1):
+        """
+        :param token: the token the bots must use
+        :param updates: number of updates in the stream
+        :param chats: number of different chats the updates are from
+        :param latency: seconds each sendXxx call takes
+        :param throttle_every: every n-th sendXxx call is rejected with 429, 0 to never reject
+        :param retry_after: retry_after of the 429 errors, in seconds
+        """
+        self.token = token
+        self.updates = updates
+        self.chats = chats
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+
+        self.webhook_url = None
+        self.allowed_updates = None
+        self.max_connections = 40
+        self.certificate = None
+
+        self.__delivered = {}
+        self.__latencies = []
+        self.__calls = 0
+        self.__throttled = 0
+        self.__documents = 0
+        self.__first_delivery = None
+        self.__last_reply = None
+        self.__next_pushed = 0
+
+    @property
+    def stats(self):
+        latencies = sorted(self.__latencies)
+        elapsed = self.__last_reply - self.__first_delivery if self.__last_reply is not None else None
+        return {
+            'delivered': len(self.__delivered),
+            'replies': len(latencies),
+            'documents': self.__documents,
+            'throttled': self.__throttled,
+            'elapsed': elapsed,
+            'updates_per_second': len(latencies) / elapsed if elapsed else None,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'webhook_url': self.webhook_url,
+        }
+
+    def create_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.__handle_method)
+        app.router.add_get('/stats', self.__handle_stats)
+        app.router.add_post('/push', self.__handle_push)
+        return app
+
+    def run(self, port, host='127.0.0.1'):
+        """Serves the fake API at given port until interrupted"""
+        web.run_app(self.create_app(), host=host, port=port, print=None, access_log=None)
+
+    async def push(self, concurrency=None):
+        """
+        POSTs the updates which were not delivered yet to the webhook,
+        with as many concurrent connections as the webhook allows
+        """
+        concurrency = concurrency or self.max_connections
+        kwargs = {}
+        if self.certificate is not None:
+            kwargs['ssl'] = ssl.create_default_context(cadata=self.certificate.decode('ascii'))
+        async with ClientSession(connector=TCPConnector(limit=concurrency, **kwargs)) as session:
+            await asyncio.gather(*(self.__push_worker(session) for _ in range(concurrency)))
+
+    async def __push_worker(self, session):
+        while self.__next_pushed < self.updates:
+            update_id = self.__next_pushed
+            self.__next_pushed += 1
+            body = json.dumps(make_update(update_id, self.chats)).encode('utf-8')
+            while True:
+                self.__deliver(update_id)
+                try:
+                    async with session.post(self.webhook_url, data=body,
+                                            headers={'Content-Type': 'application/json'}) as response:
+                        await response.read()
+                        if response.status == 200:
+                            break
+                except ClientConnectionError:
+                    pass
+                # like Telegram, retry the update until the webhook accepts it
+                del self.__delivered[update_id]
+                await asyncio.sleep(0.05)
+
+    def __deliver(self, update_id):
+        now = time.perf_counter()
+        if self.__first_delivery is None:
+            self.__first_delivery = now
+        self.__delivered[update_id] = now
+
+    async def __handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def __handle_push(self, request):
+        if self.webhook_url is None:
+            return web.json_response({'ok': False, 'description': 'webhook is not set'}, status=409)
+        asyncio.ensure_future(self.push(int(request.query.get('concurrency', 0)) or None))
+        return web.json_response({'ok': True})
+
+    async def __handle_method(self, request):
+        if request.match_info['token'] != self.token:
+            return error(401, 'Unauthorized')
+        method = request.match_info['method']
+        handler = getattr(self, '_method_' + method, None)
+        if handler is None:
+            return error(404, 'Not Found: method not found')
+
+        if request.content_type == 'multipart/form-data':
+            args = dict(request.query)
+            post = await request.post()
+            args.update({k: v for k, v in post.items()})
+        elif request.can_read_body:
+            args = await request.json()
+        else:
+            args = dict(request.query)
+        return await handler(args)
+
+    async def _method_getMe(self, args):
+        return ok({'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'})
+
+    async def _method_getUpdates(self, args):
+        if self.webhook_url is not None:
+            return error(409, 'Conflict: can\'t use getUpdates method while webhook is active')
+        offset = max(int(args.get('offset', 0)), 0)
+        limit = int(args.get('limit', 100))
+        if offset >= self.updates:
+            await asyncio.sleep(float(args.get('timeout', 0)))
+            return ok([])
+        updates = [make_update(i, self.chats) for i in range(offset, min(self.updates, offset + limit))]
+        for update in updates:
+            self.__deliver(update['update_id'])
+        return ok(updates)
+
+    async def _method_getWebhookInfo(self, args):
+        return ok({
+            'url': self.webhook_url or '',
+            'has_custom_certificate': self.certificate is not None,
+            'pending_update_count': self.updates - self.__next_pushed if self.webhook_url else 0,
+            'allowed_updates': self.allowed_updates or [],
+            'max_connections': self.max_connections,
+        })
+
+    async def _method_setWebhook(self, args):
+        self.webhook_url = args.get('url') or None
+        allowed_updates = args.get('allowed_updates')
+        self.allowed_updates = json.loads(allowed_updates) if isinstance(allowed_updates, str) else allowed_updates
+        self.max_connections = int(args.get('max_connections', 40))
+        certificate = args.get('certificate')
+        if isinstance(certificate, str) and certificate.startswith('attach://'):
+            certificate = args.get(certificate[9:])
+        self.certificate = certificate.file.read() if isinstance(certificate, web.FileField) else None
+        return ok(True)
+
+    async def _method_deleteWebhook(self, args):
+        self.webhook_url = None
+        return ok(True)
+
+    async def _method_sendMessage(self, args):
+        return await self.__send(args, {'text': args.get('text', '')})
+
+    async def _method_sendDocument(self, args):
+        document = args.get('document')
+        if isinstance(document, str) and not document.startswith('attach://'):
+            file_id = document
+        else:
+            if isinstance(document, str):
+                document = args.get(document[9:])
+            self.__documents += 1
+            file_id = 'BQACAgIAAx%s' % self.__documents
+        return await self.__send(args, {'document': {'file_id': file_id, 'file_unique_id': file_id[-8:]}})
+
+    async def __send(self, args, content):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.__calls += 1
+        if self.throttle_every and self.__calls % self.throttle_every == 0:
+            self.__throttled += 1
+            return error(429, 'Too Many Requests: retry after %s' % self.retry_after,
+                         {'retry_after': self.retry_after})
+
+        reply_to = args.get('reply_to_message_id')
+        if reply_to is not None:
+            delivered = self.__delivered.get(int(reply_to))
+            if delivered is not None:
+                now = time.perf_counter()
+                self.__latencies.append(now - delivered)
+                self.__last_reply = now
+
+        chat_id = int(args.get('chat_id', 0))
+        return ok({
+            'message_id': self.__calls,
+            'from': {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'Fake'},
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': int(time.time()),
+            **content,
+        })
+
+
+def ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def error(code, description, parameters=None):
+    body = {'ok': False, 'error_code': code, 'description': description}
+    if parameters is not None:
+        body['parameters'] = parameters
+    # Telegram answers errors with the same HTTP status as the error code
+    return web.json_response(body, status=code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server for benchmarks')
+    parser.add_argument('-p', '--port', type=int, default=8081, help='Port to listen at')
+    parser.add_argument('-t', '--token', default=TOKEN, help='The token the bots must use')
+    parser.add_argument('-u', '--updates', type=int, default=10000, help='Number of updates to serve')
+    parser.add_argument('-c', '--chats', type=int, default=100, help='Number of chats the updates are from')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='Seconds each sendXxx call takes')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Reject every n-th sendXxx call with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the 429 errors')
+    args = parser.parse_args()
+    print('serving fake Bot API for token %s at http://127.0.0.1:%s' % (args.token, args.port))
+    FakeBotAPI(args.token, args.updates, args.chats, args.latency, args.throttle_every, args.retry_after).run(args.port)
+
+
+if __name__ == '__main__':
+    main()
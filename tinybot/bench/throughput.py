@@ -0,0 +1,173 @@
+"""
+End to end throughput of a bot against the fake Bot API from `tinybot.bench.fakeapi`:
+updates per second, p50 and p99 latency from an update being delivered to
+its reply being received, and peak memory of the bot process, for longpoll
+and webhook modes with async and sync handlers.
+
+Each scenario is run in its own pair of processes, the fake API in one and
+the bot in the other, so that they do not share the event loop or the GIL
+and the peak memory is of that scenario alone.
+
+Run with `python -m tinybot.bench.throughput`, see `--help` for the options.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import resource
+import socket
+import time
+
+from aiohttp import ClientSession
+
+import tinybot
+from tinybot.bench.fakeapi import FakeBotAPI, TOKEN
+
+DOCUMENT = b'benchmark report\n' * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def reply(message, document_every):
+    """Returns the method and the arguments of the reply to given message"""
+    kwargs = {'chat_id': message.chat.id, 'reply_to_message_id': message.message_id}
+    if document_every and message.message_id % document_every == 0:
+        return 'sendDocument', dict(kwargs, document=('report.txt', DOCUMENT))
+    return 'sendMessage', dict(kwargs, text='Echo: ' + message.text)
+
+
+def create_bot(handlers, api_port, options):
+    class BenchBot(tinybot.Bot):
+        token = TOKEN
+        api_url = 'http://127.0.0.1:%s' % api_port
+        # limits high enough to never delay, the limiter is only there to retry the 429 errors
+        rate_limits = (1e9, 1e9, 1e9) if options.throttle_every else None
+        max_in_flight = options.max_in_flight
+        executor_workers = options.workers
+
+    if handlers == 'async':
+        async def handle_message(self, message, api):
+            method, kwargs = reply(message, options.document_every)
+            await getattr(api, method)(**kwargs)
+    else:
+        def handle_message(self, message, api):
+            method, kwargs = reply(message, options.document_every)
+            getattr(api, method)(**kwargs)
+
+    BenchBot.handle_message = handle_message
+    return BenchBot
+
+
+async def wait_for(stats_url, predicate, timeout):
+    """Polls the fake API stats until predicate is true for them, returns the last stats"""
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while True:
+            async with session.get(stats_url) as response:
+                stats = await response.json()
+            if predicate(stats) or time.monotonic() > deadline:
+                return stats
+            await asyncio.sleep(0.05)
+
+
+async def drive(mode, bot_cls, api_port, options):
+    base_url = 'http://127.0.0.1:%s' % api_port
+    stats_url = base_url + '/stats'
+
+    if mode == 'longpoll':
+        task = asyncio.ensure_future(bot_cls.serve_longpoll(1))
+    else:
+        bot_port = free_port()
+        task = asyncio.ensure_future(bot_cls.serve_webhook('http://127.0.0.1:%s' % bot_port, bot_port))
+        await wait_for(stats_url, lambda s: s['webhook_url'] or task.done(), 10)
+        async with ClientSession() as session:
+            await session.post(base_url + '/push')
+
+    stats = await wait_for(stats_url, lambda s: s['replies'] >= options.updates or task.done(), options.timeout)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return stats
+
+
+def run_bot(connection, mode, handlers, api_port, options):
+    logging.getLogger('tinybot').setLevel(logging.WARNING)
+    bot_cls = create_bot(handlers, api_port, options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stats = loop.run_until_complete(drive(mode, bot_cls, api_port, options))
+    # ru_maxrss is in kilobytes on linux
+    stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    connection.send(stats)
+
+
+def run_scenario(mode, handlers, options):
+    context = multiprocessing.get_context('fork')
+    api_port = free_port()
+    fake = FakeBotAPI(TOKEN, options.updates, options.chats, options.latency,
+                      options.throttle_every, options.retry_after)
+    server = context.Process(target=fake.run, args=(api_port,), daemon=True)
+    server.start()
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', api_port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+        receiver, sender = context.Pipe(duplex=False)
+        bot = context.Process(target=run_bot, args=(sender, mode, handlers, api_port, options))
+        bot.start()
+        # so that recv fails instead of waiting forever if the bot process dies
+        sender.close()
+        try:
+            return receiver.recv()
+        except EOFError:
+            raise RuntimeError('%s scenario with %s handlers failed, exit code %s'
+                               % (mode, handlers, bot.exitcode)) from None
+        finally:
+            bot.join()
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks a bot against a local fake Telegram Bot API')
+    parser.add_argument('-m', '--mode', choices=('longpoll', 'webhook', 'all'), default='all')
+    parser.add_argument('-H', '--handlers', choices=('async', 'sync', 'all'), default='all')
+    parser.add_argument('-u', '--updates', type=int, default=5000, help='Number of updates per scenario')
+    parser.add_argument('-c', '--chats', type=int, default=100, help='Number of chats the updates are from')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='Seconds each reply call takes')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Reject every n-th reply call with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the 429 errors')
+    parser.add_argument('--document-every', type=int, default=0, help='Reply to every n-th update with a document')
+    parser.add_argument('--max-in-flight', type=int, default=tinybot.Bot.max_in_flight)
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads for sync handlers')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds after which a scenario is stopped')
+    options = parser.parse_args()
+
+    modes = ('longpoll', 'webhook') if options.mode == 'all' else (options.mode,)
+    kinds = ('async', 'sync') if options.handlers == 'all' else (options.handlers,)
+
+    print(f'{"mode":<10}{"handlers":<10}{"replies":>9}{"updates/s":>11}{"p50, ms":>10}{"p99, ms":>10}'
+          f'{"429s":>7}{"peak rss, MB":>14}')
+    for mode in modes:
+        for kind in kinds:
+            stats = run_scenario(mode, kind, options)
+            ups = stats['updates_per_second'] or 0
+            p50 = (stats['p50'] or 0) * 1000
+            p99 = (stats['p99'] or 0) * 1000
+            print(f'{mode:<10}{kind:<10}{stats["replies"]:>9}{ups:>11.0f}{p50:>10.1f}{p99:>10.1f}'
+                  f'{stats["throttled"]:>7}{stats["peak_rss"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+import os
+from time import monotonic
+
+from aiohttp import ClientError
+
+import tinybot.logger as tlogger
+from tinybot.ratelimit import RateLimiter
+from tinybot.webapi import RequestError
+
+__all__ = ('Broadcast', 'broadcast', 'classify_error')
+
+logger = tlogger.get('tinybot.broadcaster')
+
+# descriptions of the 400 errors telling that the target does not exist
+NOT_FOUND = ('chat not found', 'user not found', 'peer_id_invalid', 'chat_id_invalid')
+
+
+def classify_error(error):
+    """
+    Returns how a failed call to a broadcast target is reported: 'retry' for the errors which might not
+    happen again (flood limits, server and network errors), 'blocked' when the bot can not write to the target
+    (blocked by the user, kicked from the chat, the user is deactivated), 'not_found' when the target
+    does not exist, and 'failed' for the rest, e.g. bad arguments
+    """
+    if not isinstance(error, RequestError):
+        return 'retry'
+    if error.code is None or error.code >= 500 or error.retry_after is not None:
+        return 'retry'
+    if error.code == 403:
+        return 'blocked'
+    if error.code == 400 and any(s in error.args[0].lower() for s in NOT_FOUND):
+        return 'not_found'
+    return 'failed'
+
+
+class Broadcast:
+    """
+    Calls one method for each of many targets, such as sending an announcement to all of the subscribers.
+
+    The targets are read from an iterable or an async iterable as they are needed and called with
+    bounded concurrency, as fast as the rate limiter of the API allows (or a limiter of its own, if the API
+    has none). Failures which might not happen again are retried with a backoff, groups which became
+    supergroups are called again with their new id, and the rest of the failures are classified (see
+    `classify_error`) and counted in `stats`.
+
+    With a checkpoint path, the result for each target is appended to that file, and the targets
+    which are in it are skipped, so that an interrupted broadcast started again continues where it stopped.
+    The targets being called when it was interrupted might get the call twice. The targets which still failed
+    after all of the retries ('gave_up') are not written to it, so they are called again by the next run.
+    """
+
+    progress_interval = 10
+    """Seconds between the progress messages logged"""
+
+    def __init__(self, api, method, targets, kwargs=None, concurrency=20, retries=3, checkpoint=None,
+                 on_result=None, target_arg='chat_id', rate=30):
+        """
+        :param api: TelegramAPI the calls are made with
+        :param method: name of the called method, e.g. 'sendMessage'
+        :param targets: iterable or async iterable of the targets, chat ids usually
+        :param kwargs: arguments of the calls besides the target
+        :param concurrency: maximum number of calls made at the same time
+        :param retries: number of times a call is repeated after a failure which might not happen again
+        :param checkpoint: optional path of the file the progress is kept in
+        :param on_result: optional function called with each target, its status ('sent', 'blocked',
+        'not_found', 'failed' or 'gave_up') and the result of the call or the error
+        :param target_arg: name of the argument the target is given as
+        :param rate: calls per second when the API has no rate limiter
+        """
+        self.__api = api
+        self.__method = method
+        self.__targets = targets
+        self.__kwargs = dict(kwargs or {})
+        self.__concurrency = concurrency
+        self.__retries = retries
+        self.__checkpoint = os.fspath(checkpoint) if checkpoint is not None else None
+        self.__on_result = on_result
+        self.__target_arg = target_arg
+        self.__limiter = RateLimiter(rate) if api.limiter is None else None
+        self.__codec = api.codec
+        self.__file = None
+        self.stats = {'sent': 0, 'blocked': 0, 'not_found': 0, 'failed': 0, 'gave_up': 0, 'retries': 0,
+                      'skipped': 0}
+        """Number of the targets by their status, of the retried calls and of the targets skipped by the checkpoint"""
+
+    async def run(self):
+        """Makes all of the calls, returns the stats"""
+        done = self.__load_checkpoint()
+        if self.__checkpoint is not None:
+            self.__file = open(self.__checkpoint, 'ab')
+        queue = asyncio.Queue(self.__concurrency * 2)
+        workers = [asyncio.ensure_future(self.__work(queue)) for _ in range(self.__concurrency)]
+        reporter = asyncio.ensure_future(self.__report())
+        start = monotonic()
+        try:
+            async for target in iterate(self.__targets):
+                if target in done:
+                    self.stats['skipped'] += 1
+                    continue
+                await queue.put(target)
+            await queue.join()
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+        logger.info('broadcast of %s is done in %.1f seconds: %s', self.__method, monotonic() - start, self.stats)
+        return self.stats
+
+    async def __work(self, queue):
+        while True:
+            target = await queue.get()
+            try:
+                status, result = await self.__call(target)
+                self.__record(target, status, result)
+            finally:
+                queue.task_done()
+
+    async def __call(self, target):
+        kwargs = dict(self.__kwargs)
+        kwargs[self.__target_arg] = target
+        attempt = 0
+        while True:
+            if self.__limiter is not None:
+                limited = self.__limiter.limits(self.__method)
+                await self.__limiter.acquire(kwargs[self.__target_arg] if limited else None)
+            try:
+                return 'sent', await self.__api.request(self.__method, **kwargs)
+            except (RequestError, ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except Exception as e:
+                # a bug rather than a bad target, but the rest of the targets still get their calls
+                logger.warning('calling %s for %s failed, %r', self.__method, target, e)
+                return 'failed', e
+
+            migrated = error.parameters.get('migrate_to_chat_id') \
+                if isinstance(error, RequestError) and error.parameters is not None else None
+            if migrated is not None and migrated != kwargs[self.__target_arg]:
+                kwargs[self.__target_arg] = migrated
+                continue
+
+            status = classify_error(error)
+            if status != 'retry':
+                return status, error
+            if attempt >= self.__retries:
+                return 'gave_up', error
+            attempt += 1
+            self.stats['retries'] += 1
+            delay = error.retry_after if isinstance(error, RequestError) and error.retry_after else 2 ** attempt
+            if self.__limiter is not None and isinstance(error, RequestError) and error.retry_after:
+                # it is a flood limit for the bot as a whole, so all of the calls wait
+                self.__limiter.block(delay)
+            await asyncio.sleep(delay)
+
+    def __record(self, target, status, result):
+        self.stats[status] += 1
+        if status != 'sent':
+            description = result.args[0] if isinstance(result, RequestError) else repr(result)
+            logger.debug('calling %s for %s failed (%s), %s', self.__method, target, status, description)
+        # the targets which were given up on are not done, the next run tries them again
+        if self.__file is not None and status != 'gave_up':
+            self.__file.write(self.__codec.dumps([target, status]) + b'\n')
+            # flushed, not synced, so only a crash of the machine loses the last records
+            self.__file.flush()
+        if self.__on_result is not None:
+            # noinspection PyBroadException
+            try:
+                self.__on_result(target, status, result)
+            except Exception as e:
+                logger.warning('on_result of the broadcast failed for %s, %r', target, e)
+
+    def __load_checkpoint(self):
+        done = set()
+        if self.__checkpoint is None or not os.path.exists(self.__checkpoint):
+            return done
+        with open(self.__checkpoint, 'rb') as f:
+            for line in f:
+                try:
+                    target, status = self.__codec.loads(line)
+                except ValueError:
+                    # the last line might be cut by a crash
+                    continue
+                done.add(target)
+                self.stats[status] += 1
+        if done:
+            logger.info('resuming the broadcast of %s, %s targets are done already', self.__method, len(done))
+        return done
+
+    async def __report(self):
+        last, last_time = 0, monotonic()
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            total = sum(self.stats[k] for k in ('sent', 'blocked', 'not_found', 'failed', 'gave_up'))
+            now = monotonic()
+            logger.info('broadcast of %s: %s targets done, %.1f per second, %s', self.__method, total,
+                        (total - last) / (now - last_time), self.stats)
+            last, last_time = total, now
+
+
+async def iterate(targets):
+    if hasattr(targets, '__aiter__'):
+        async for target in targets:
+            yield target
+    else:
+        for target in targets:
+            yield target
+
+
+async def broadcast(api, method, targets, concurrency=20, retries=3, checkpoint=None, on_result=None,
+                    target_arg='chat_id', rate=30, **kwargs):
+    """
+    Calls given method with given kwargs for each of the targets as their `target_arg`, returns the stats.
+    See `Broadcast` for the details of the options, e.g.
+    `await broadcast(api, 'sendMessage', subscribers, checkpoint='news.progress', text='News!')`
+    """
+    return await Broadcast(api, method, targets, kwargs, concurrency, retries, checkpoint, on_result,
+                           target_arg, rate).run()
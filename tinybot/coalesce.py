@@ -0,0 +1,132 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+__all__ = ('Coalescer',)
+
+EDIT_TYPES = ('edited_message', 'edited_channel_post', 'edited_business_message')
+
+
+class Coalescer:
+    """
+    Stage in front of a dispatcher which drops the updates whose handling would be wasted:
+     - duplicates of recently seen update_ids, such as webhook deliveries Telegram retried
+     - edits of a message superseded by a newer edit of it within `edit_window` seconds,
+       edits are held for that long so that only the newest one of a burst is handled
+     - callback queries with the same data from the same user within `callback_window` seconds
+       of the last handled one, such as repeated clicks on a button
+
+    Each policy is off when its parameter is None. It has the same interface as the
+    dispatchers, so it is used in place of the one it wraps. The dropped updates
+    are counted by policy in `dropped` and given to `on_drop`.
+    """
+
+    def __init__(self, dispatcher, dedup_size=None, edit_window=None, callback_window=None,
+                 on_drop=None, metrics=None):
+        """
+        :param dispatcher: the dispatcher the updates which are not dropped are submitted to
+        :param dedup_size: number of the most recent update_ids remembered to drop their duplicates
+        :param edit_window: seconds an edit is held for, waiting for a newer edit of the same message
+        :param callback_window: seconds during which identical callback queries of a user are dropped
+        :param on_drop: optional function called with each dropped update and the name of the policy which dropped it
+        :param metrics: optional tinybot.metrics.Metrics the dropped updates are counted in
+        """
+        self.__dispatcher = dispatcher
+        self.__dedup_size = dedup_size
+        self.__edit_window = edit_window
+        self.__callback_window = callback_window
+        self.__on_drop = on_drop
+        self.__metrics = metrics
+        self.__seen = OrderedDict()
+        self.__edits = {}
+        self.__clicks = OrderedDict()
+        self.dropped = {'duplicate': 0, 'edit': 0, 'callback': 0}
+        """Number of the dropped updates by the policy which dropped them"""
+
+    @property
+    def in_flight(self):
+        return self.__dispatcher.in_flight
+
+    @property
+    def queue_depth(self):
+        return self.__dispatcher.queue_depth
+
+    @property
+    def held(self):
+        """Number of edits held back waiting for newer ones"""
+        return len(self.__edits)
+
+    @property
+    def saturated(self):
+        return self.__dispatcher.saturated
+
+    def submit(self, update):
+        update_id = update.get('update_id')
+        if self.__dedup_size and update_id is not None:
+            if update_id in self.__seen:
+                return self.__drop(update, 'duplicate')
+            self.__seen[update_id] = None
+            if len(self.__seen) > self.__dedup_size:
+                self.__seen.popitem(last=False)
+
+        for name, data in update.items():
+            if name == 'update_id':
+                continue
+            if name in EDIT_TYPES and self.__edit_window is not None:
+                return self.__hold_edit(name, data, update)
+            if name == 'callback_query' and self.__callback_window is not None and self.__debounced(data):
+                return self.__drop(update, 'callback')
+        self.__dispatcher.submit(update)
+
+    async def wait_ready(self):
+        await self.__dispatcher.wait_ready()
+
+    async def join(self):
+        """Submits the held edits right away and waits until all of the submitted updates are handled"""
+        for key in list(self.__edits):
+            self.__release(key)
+        await self.__dispatcher.join()
+
+    def close(self):
+        """Closes the dispatcher, held edits are dropped without calling `on_drop`"""
+        for _, handle in self.__edits.values():
+            handle.cancel()
+        self.__edits.clear()
+        self.__dispatcher.close()
+
+    def __hold_edit(self, name, data, update):
+        key = (name, data.get('chat') and data.chat.get('id'), data.get('message_id'))
+        held = self.__edits.get(key)
+        if held is None:
+            handle = asyncio.get_event_loop().call_later(self.__edit_window, self.__release, key)
+            self.__edits[key] = (update, handle)
+            return
+        held_update, handle = held
+        # deliveries can come out of order, the one with the bigger id is the newer edit
+        if (update.get('update_id') or 0) < (held_update.get('update_id') or 0):
+            return self.__drop(update, 'edit')
+        self.__edits[key] = (update, handle)
+        self.__drop(held_update, 'edit')
+
+    def __release(self, key):
+        update, handle = self.__edits.pop(key)
+        handle.cancel()
+        self.__dispatcher.submit(update)
+
+    def __debounced(self, data):
+        now = monotonic()
+        # forgets the clicks which are out of the window, they are in the order they were made
+        while self.__clicks and next(iter(self.__clicks.values())) <= now - self.__callback_window:
+            self.__clicks.popitem(last=False)
+        key = (data.get('from') and data['from'].get('id'), data.get('data'))
+        if key in self.__clicks:
+            return True
+        self.__clicks[key] = now
+        return False
+
+    def __drop(self, update, policy):
+        self.dropped[policy] += 1
+        if self.__metrics is not None:
+            self.__metrics.count_dropped(policy)
+        if self.__on_drop is not None:
+            self.__on_drop(update, policy)
@@ -0,0 +1,68 @@
+import json
+
+__all__ = ('StdlibCodec', 'OrjsonCodec', 'UjsonCodec', 'default_codec')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class StdlibCodec:
+    """
+    JSON codec working with bytes, used for request and response bodies.
+    This one is based on the standard json module and is always available.
+    Decoding errors are raised as ValueError subclasses by all of the codecs.
+    """
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """Codec based on orjson, which is the fastest one when installed"""
+
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+class UjsonCodec:
+    """Codec based on ujson"""
+
+    name = 'ujson'
+
+    @staticmethod
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(data)
+
+
+def default_codec():
+    """Returns the fastest of the installed codecs"""
+    if orjson is not None:
+        return OrjsonCodec
+    if ujson is not None:
+        return UjsonCodec
+    return StdlibCodec
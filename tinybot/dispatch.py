@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+from time import perf_counter
+
+from tinybot.webapi import DynamicDictObject
+
+__all__ = ('Scheduler', 'ShardedDispatcher', 'shard_key')
+
+
+def shard_key(update):
+    """
+    Returns the id of the chat the update belongs to or, for updates without
+    a chat (inline queries and such), the id of the user who caused it.
+    """
+    for name, data in update.items():
+        if name == 'update_id' or not isinstance(data, DynamicDictObject):
+            continue
+        # callback queries have the chat in the message they are attached to
+        for obj in (data, data.get('message')):
+            if obj is not None and 'chat' in obj:
+                return obj.chat.get('id')
+        for field in ('from', 'user'):
+            if field in data:
+                return data[field].get('id')
+    return None
+
+
+class Scheduler:
+    """
+    Runs update handling as tasks, keeping at most `limit` of them in flight.
+    Updates submitted over the limit wait in a queue and are started as soon
+    as running tasks complete, finished tasks are forgotten right away.
+    """
+
+    def __init__(self, dispatch, limit=100, metrics=None):
+        """
+        :param dispatch: coroutine function which handles a single update
+        :param limit: maximum number of updates being handled at the same time
+        :param metrics: optional tinybot.metrics.Metrics the time updates wait in the queue is recorded to
+        """
+        self.__dispatch = dispatch
+        self.__limit = limit
+        self.__metrics = metrics
+        self.__tasks = set()
+        self.__queue = deque()
+        self.__ready = asyncio.Event()
+        self.__ready.set()
+
+    @property
+    def in_flight(self):
+        """Number of updates being handled right now"""
+        return len(self.__tasks)
+
+    @property
+    def queue_depth(self):
+        """Number of updates waiting for a free slot"""
+        return len(self.__queue)
+
+    @property
+    def saturated(self):
+        return len(self.__tasks) >= self.__limit
+
+    def submit(self, update):
+        if len(self.__tasks) < self.__limit:
+            if self.__metrics is not None:
+                self.__metrics.observe_queue_wait(0.0)
+            self.__start(update)
+        else:
+            self.__queue.append((update, perf_counter()))
+
+    async def wait_ready(self):
+        """Waits until there is a free slot and no queued updates"""
+        await self.__ready.wait()
+
+    async def join(self):
+        """Waits until all submitted updates are handled"""
+        while self.__tasks:
+            await asyncio.wait(set(self.__tasks))
+
+    def close(self):
+        # running tasks are left to finish on their own
+        pass
+
+    def __start(self, update):
+        task = asyncio.ensure_future(self.__dispatch(update))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__done)
+        if len(self.__tasks) >= self.__limit:
+            self.__ready.clear()
+
+    def __done(self, task):
+        self.__tasks.discard(task)
+        if self.__queue:
+            update, queued_at = self.__queue.popleft()
+            if self.__metrics is not None:
+                self.__metrics.observe_queue_wait(perf_counter() - queued_at)
+            self.__start(update)
+        elif len(self.__tasks) < self.__limit:
+            self.__ready.set()
+
+
+class ShardedDispatcher:
+    """
+    Spreads updates over a number of worker queues by the chat (or user) they
+    belong to. Each worker handles its updates one by one, so the updates from
+    the same chat are handled in the order they came in, while updates from
+    different chats are handled in parallel.
+    """
+
+    def __init__(self, dispatch, shards, limit=100, metrics=None):
+        """
+        :param dispatch: coroutine function which handles a single update
+        :param shards: number of worker queues
+        :param limit: number of queued updates at which the dispatcher is considered saturated
+        :param metrics: optional tinybot.metrics.Metrics the time updates wait in the queues is recorded to
+        """
+        self.__dispatch = dispatch
+        self.__limit = limit
+        self.__metrics = metrics
+        self.__queues = [asyncio.Queue() for _ in range(shards)]
+        self.__workers = [asyncio.ensure_future(self.__work(q)) for q in self.__queues]
+        self.__busy = 0
+        self.__queued = 0
+        self.__ready = asyncio.Event()
+        self.__ready.set()
+
+    @property
+    def in_flight(self):
+        """Number of updates being handled right now"""
+        return self.__busy
+
+    @property
+    def queue_depth(self):
+        """Number of updates waiting in all of the queues"""
+        return self.__queued
+
+    @property
+    def saturated(self):
+        return self.__queued >= self.__limit
+
+    def submit(self, update):
+        key = shard_key(update)
+        if key is None:
+            key = update.get('update_id') or 0
+        self.__queues[hash(key) % len(self.__queues)].put_nowait((update, perf_counter()))
+        self.__queued += 1
+        if self.__queued >= self.__limit:
+            self.__ready.clear()
+
+    async def wait_ready(self):
+        """Waits until the number of queued updates drops below the limit"""
+        await self.__ready.wait()
+
+    async def join(self):
+        """Waits until all submitted updates are handled"""
+        for q in self.__queues:
+            await q.join()
+
+    def close(self):
+        """Stops the workers, queued updates are dropped"""
+        for worker in self.__workers:
+            worker.cancel()
+
+    async def __work(self, queue):
+        while True:
+            update, queued_at = await queue.get()
+            if self.__metrics is not None:
+                self.__metrics.observe_queue_wait(perf_counter() - queued_at)
+            self.__queued -= 1
+            if self.__queued < self.__limit:
+                self.__ready.set()
+            self.__busy += 1
+            try:
+                await self.__dispatch(update)
+            finally:
+                self.__busy -= 1
+                queue.task_done()
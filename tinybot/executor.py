@@ -0,0 +1,203 @@
+import os
+import secrets
+import sys
+from re import Match
+from asyncio import run_coroutine_threadsafe
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.connection import Listener, Client
+from threading import Thread
+
+import tinybot.logger as tlogger
+from tinybot.webapi import TelegramAPI, BlockingTelegramAPI, DynamicDictObject, RequestError
+
+__all__ = ('ThreadRunner', 'ProcessRunner', 'ProxyTelegramAPI')
+
+logger = tlogger.get('tinybot.executor')
+
+
+def cpu_count():
+    # the CPUs the process may use, os.process_cpu_count is new in Python 3.13
+    return getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+
+
+def thread_workers(workers):
+    """Returns the size of a ThreadPoolExecutor made with given max_workers, as documented"""
+    return workers if workers is not None else min(32, cpu_count() + 4)
+
+
+def process_workers(workers):
+    """Returns the size of a ProcessPoolExecutor made with given max_workers, as documented"""
+    if workers is not None:
+        return workers
+    return min(61, cpu_count()) if sys.platform == 'win32' else cpu_count()
+
+
+class ThreadRunner:
+    """Runs sync handlers in a dedicated thread pool, giving them a BlockingTelegramAPI"""
+
+    def __init__(self, api, loop, workers=None, deferred=False):
+        """
+        :param api: the API the handlers calls are made with
+        :param loop: the event loop the API is used on
+        :param workers: size of the pool, defaults to ThreadPoolExecutor default
+        :param deferred: if True, each handler is run in the `BlockingTelegramAPI.deferred` context,
+        so its calls return futures and are waited for after it returns.
+        With 'detach' they are not waited for at all, and the thread is free for the next handler right away
+        """
+        self.__loop = loop
+        self.__api = BlockingTelegramAPI(api, loop)
+        self.__deferred = deferred
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix='tinybot-handler')
+        self.__workers = thread_workers(workers)
+        self.__pending = 0
+
+    @property
+    def pending(self):
+        """Number of handler calls submitted and not finished yet"""
+        return self.__pending
+
+    @property
+    def queue_depth(self):
+        """Number of handler calls waiting for a free thread"""
+        return max(0, self.__pending - self.__workers)
+
+    def run(self, func, param_name, data, *args):
+        """Returns a future for calling given bound handler with given update data and extra arguments"""
+        future = self.__loop.run_in_executor(self.__executor, self.__call, func, data.with_root(param_name), args)
+        self.__pending += 1
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future):
+        self.__pending -= 1
+
+    def __call(self, func, data, args):
+        if not self.__deferred:
+            return func(data, self.__api, *args)
+        with self.__api.deferred(wait=self.__deferred != 'detach'):
+            return func(data, self.__api, *args)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+
+
+class ProcessRunner:
+    """
+    Runs sync handlers in a process pool, so CPU-bound handlers are not limited by the GIL.
+
+    Each worker process keeps its own instance of the bot class, and its
+    handlers get a ProxyTelegramAPI which sends the calls back to the main
+    process to be made there. So the update data, the call arguments and the
+    results must be picklable (files can be sent as BytesIO but not as
+    opened files), and the bot class must be importable by its module name.
+    """
+
+    def __init__(self, api, loop, workers=None):
+        """
+        :param api: the API the proxied calls are made with
+        :param loop: the event loop the API is used on
+        :param workers: number of processes, defaults to the number of CPUs
+        """
+        self.__api = api
+        self.__loop = loop
+        authkey = secrets.token_bytes(32)
+        self.__listener = Listener(authkey=authkey)
+        Thread(target=self.__accept, name='tinybot-api-proxy', daemon=True).start()
+        self.__executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                              initargs=(self.__listener.address, authkey))
+        self.__workers = process_workers(workers)
+        self.__pending = 0
+
+    @property
+    def pending(self):
+        """Number of handler calls submitted and not finished yet"""
+        return self.__pending
+
+    @property
+    def queue_depth(self):
+        """Number of handler calls waiting for a free process"""
+        return max(0, self.__pending - self.__workers)
+
+    def run(self, func, param_name, data, *args):
+        """
+        Returns a future for calling given bound handler with given update data and extra arguments
+        in a worker process. The arguments must be picklable, `re.Match` objects are given as their groups
+        """
+        args = tuple(a.groups() if isinstance(a, Match) else a for a in args)
+        future = self.__loop.run_in_executor(self.__executor, _call_handler, type(func.__self__), func.__name__,
+                                             param_name, data.unwrap(), *args)
+        self.__pending += 1
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future):
+        self.__pending -= 1
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__listener.close()
+
+    def __accept(self):
+        while True:
+            try:
+                connection = self.__listener.accept()
+            except OSError:
+                return
+            Thread(target=self.__serve, args=(connection,), name='tinybot-api-proxy', daemon=True).start()
+
+    def __serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = run_coroutine_threadsafe(self.__api.request(method, **kwargs), self.__loop).result()
+                    connection.send((True, result.unwrap() if isinstance(result, DynamicDictObject) else result))
+                except RequestError as e:
+                    parameters = e.parameters.unwrap() if isinstance(e.parameters, DynamicDictObject) else None
+                    connection.send((False, e.args[0], e.code, parameters))
+                except Exception as e:
+                    logger.warning('proxied call to %s failed: %r', method, e)
+                    connection.send((False, 'proxied call to \'%s\' failed: %r' % (method, e), None, None))
+
+
+class ProxyTelegramAPI:
+    """
+    Blocking API used by sync handlers in worker processes,
+    it sends all of the calls to the main process
+    """
+
+    def __init__(self, connection):
+        self.__connection = connection
+
+    def request(self, method, **kwargs):
+        kwargs = {k: v.unwrap() if isinstance(v, DynamicDictObject) else v for k, v in kwargs.items()}
+        self.__connection.send((method, kwargs))
+        ok, *result = self.__connection.recv()
+        if ok:
+            return DynamicDictObject(result[0])
+        message, code, parameters = result
+        raise RequestError(message, code, parameters)
+
+    def __getattr__(self, item):
+        return TelegramAPI.Method(self, item)
+
+
+_api = None
+_instances = {}
+
+
+def _init_worker(address, authkey):
+    global _api
+    _api = ProxyTelegramAPI(Client(address, authkey=authkey))
+
+
+def _call_handler(bot_cls, name, param_name, data, *args):
+    instance = _instances.get(bot_cls)
+    if instance is None:
+        # a forked worker has a copy of the state store, the changes to which would be lost
+        bot_cls.state_store = None
+        instance = _instances[bot_cls] = bot_cls()
+    return getattr(instance, name)(DynamicDictObject(data).with_root(param_name), _api, *args)
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from hashlib import blake2b
+from io import IOBase, TextIOBase
+from mmap import mmap
+from pathlib import PurePath
+from threading import Lock
+
+import tinybot.logger as tlogger
+
+__all__ = ('FileIdCache', 'content_key')
+
+logger = tlogger.get('tinybot.filecache')
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_key(input_file):
+    """
+    Returns the cache key of given InputFile: its own key if it has one, or the
+    hash of its content. Returns None for files which can not be read twice,
+    such as async iterables or unseekable file objects.
+    Reads the files, so it is better to call it in an executor.
+    """
+    if input_file.key is not None:
+        return input_file.key
+    file = input_file.file
+    h = blake2b(digest_size=20)
+    if isinstance(file, (bytes, bytearray, memoryview, mmap)):
+        h.update(file)
+    elif isinstance(file, PurePath):
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+    elif isinstance(file, IOBase) and file.seekable():
+        position = file.tell()
+        try:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b'' if not isinstance(file, TextIOBase) else ''):
+                h.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        finally:
+            file.seek(position)
+    else:
+        return None
+    return h.hexdigest()
+
+
+class FileIdCache:
+    """
+    LRU mapping of file keys (see `content_key`) to the file_ids Telegram gave
+    to the files when they were first sent, so the same content is then sent
+    by reference instead of being uploaded again.
+
+    With a path given, the mapping is loaded from that file and saved back to it
+    in an executor `save_delay` seconds after a new file_id is added, along with
+    the ones added meanwhile. Call `save` to write it right away, such as when the bot stops.
+    """
+
+    save_delay = 5
+    """Seconds after a new file_id is added before the mapping is saved"""
+
+    def __init__(self, capacity=1024, path=None):
+        self.__capacity = capacity
+        self.__path = os.fspath(path) if path is not None else None
+        self.__ids = OrderedDict()
+        self.__timer = None
+        self.__version = 0
+        self.__saved_version = 0
+        self.__lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.__path is not None and os.path.exists(self.__path):
+            try:
+                with open(self.__path, 'r') as f:
+                    self.__ids.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning('failed to load file_id cache from %s: %s', path, e)
+            while len(self.__ids) > capacity:
+                self.__ids.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def get(self, key):
+        file_id = self.__ids.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__ids.move_to_end(key)
+        return file_id
+
+    def put(self, key, file_id):
+        if self.__ids.get(key) == file_id:
+            return
+        self.__ids[key] = file_id
+        self.__ids.move_to_end(key)
+        while len(self.__ids) > self.__capacity:
+            self.__ids.popitem(last=False)
+        self.__version += 1
+        if self.__path is None or self.__timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # used outside of an event loop, e.g. by a script
+            self.save()
+            return
+        self.__timer = loop.call_later(self.save_delay, self.__save_later, loop)
+
+    def discard(self, key):
+        self.__ids.pop(key, None)
+
+    def save(self):
+        """Writes the mapping to the file right away if it has new file_ids"""
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if self.__path is not None:
+            self.__write(dict(self.__ids), self.__version)
+
+    def __save_later(self, loop):
+        self.__timer = None
+        loop.run_in_executor(None, self.__write, dict(self.__ids), self.__version)
+
+    def __write(self, ids, version):
+        with self.__lock:
+            # a newer version might have been written by `save` already
+            if version <= self.__saved_version:
+                return
+            tmp = self.__path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(ids, f)
+                os.replace(tmp, self.__path)
+            except OSError as e:
+                logger.warning('failed to save file_id cache to %s: %s', self.__path, e)
+                return
+            self.__saved_version = version
@@ -1,22 +1,96 @@
-from datetime import datetime, timedelta
+"""
+Self-signed certificates for serving the webhook over HTTPS without a TLS proxy in front.
+
+The keys are ECDSA P-256 ones, which are generated in a millisecond (unlike
+RSA-2048 ones) and make TLS handshakes cheaper too. The certificate is cached
+on disk and reused until it is close to expiry, so restarts do not make a new one
+and the webhook does not have to be set again with it.
+"""
+import ipaddress
+import logging
+import os
+from datetime import datetime, timedelta, timezone
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.hashes import SHA256
-from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, NoEncryption
 from cryptography.x509.oid import NameOID
 
+__all__ = ('gencert', 'load_or_create')
+
+# imported lazily after the package, whose `logger` attribute shadows the tinybot.logger module by then
+logger = logging.getLogger('tinybot.gencert')
+
 
-def gencert(domain):
-    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+def gencert(domain, days=365):
+    """
+    Generates a self-signed certificate for given domain or IP address with an ECDSA P-256 key,
+    as Telegram wants it for webhooks: the domain is the common name of the certificate.
+    Returns the certificate and the private key, both PEM encoded
+    """
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
     name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
-    return x509.CertificateBuilder() \
+    try:
+        alt_name = x509.IPAddress(ipaddress.ip_address(domain))
+    except ValueError:
+        alt_name = x509.DNSName(domain)
+    now = datetime.now(timezone.utc)
+    cert = x509.CertificateBuilder() \
         .subject_name(name) \
         .issuer_name(name) \
         .public_key(key.public_key()) \
         .serial_number(x509.random_serial_number()) \
-        .not_valid_before(datetime.utcnow()) \
-        .not_valid_after(datetime.utcnow() + timedelta(days=10)) \
-        .sign(key, SHA256(), default_backend()) \
-        .public_bytes(Encoding.PEM)
+        .not_valid_before(now - timedelta(minutes=5)) \
+        .not_valid_after(now + timedelta(days=days)) \
+        .add_extension(x509.SubjectAlternativeName([alt_name]), critical=False) \
+        .sign(key, SHA256(), default_backend())
+    return cert.public_bytes(Encoding.PEM), \
+        key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+
+
+def load_or_create(domain, directory, days=365, renew_before=30):
+    """
+    Returns the paths of the certificate and the key for given domain cached in given directory,
+    and whether they were just created. A new certificate valid for `days` days is made if there is
+    none, if it is for another domain, or if it expires in less than `renew_before` days
+    """
+    directory = os.fspath(directory)
+    cert_path = os.path.join(directory, domain + '.pem')
+    key_path = os.path.join(directory, domain + '.key')
+
+    expires = cached_expiry(cert_path, domain)
+    if expires is not None and os.path.exists(key_path) \
+            and expires - datetime.now(timezone.utc) > timedelta(days=renew_before):
+        return cert_path, key_path, False
+
+    logger.info('generating a self-signed certificate for %s', domain)
+    cert, key = gencert(domain, days)
+    os.makedirs(directory, exist_ok=True)
+    write_atomically(key_path, key, 0o600)
+    write_atomically(cert_path, cert, 0o644)
+    return cert_path, key_path, True
+
+
+def cached_expiry(cert_path, domain):
+    """Returns when the certificate at given path expires, None if there is none or it is not for given domain"""
+    try:
+        with open(cert_path, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    except (OSError, ValueError):
+        return None
+    names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    if not names or names[0].value != domain:
+        return None
+    expires = getattr(cert, 'not_valid_after_utc', None)
+    # older versions of cryptography only have the naive one
+    return expires if expires is not None else cert.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+def write_atomically(path, data, mode):
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -0,0 +1,166 @@
+import asyncio
+import os
+
+import tinybot.logger as tlogger
+from tinybot.codec import default_codec
+
+__all__ = ('Journal',)
+
+logger = tlogger.get('tinybot.journal')
+
+
+class Journal:
+    """
+    Append-only file of received updates and of the ids of the handled ones,
+    one JSON record per line: {"u": update} when an update is received,
+    {"d": update_id} when it is handled, and {"o": update_id} for the last
+    received update id when the journal is compacted.
+
+    The received records are fsync'ed in batches before the updates are
+    acknowledged to Telegram, so after a crash the updates which were received
+    but not handled are handled again (at-least-once handling).
+    """
+
+    compact_every = 10000
+    """Number of records after which the journal is rewritten with only the unhandled updates"""
+
+    def __init__(self, path, codec=None, compact=True):
+        """
+        :param path: path of the journal file, created if it does not exist
+        :param codec: JSON codec for the records
+        :param compact: whether the handled updates are dropped from the file,
+        turn it off to record all of the updates for a later replay
+        """
+        self.__path = os.fspath(path)
+        self.__codec = codec or default_codec()
+        self.__compact = compact
+        self.__incomplete = {}
+        self.__last_id = -1
+        self.__records = 0
+        self.__file = None
+
+    @property
+    def last_id(self):
+        """Id of the last received update, -1 if none were received"""
+        return self.__last_id
+
+    def recover(self):
+        """
+        Reads the existing journal and opens it for writing.
+        Returns the updates which were received but not handled, in order
+        """
+        for kind, value in self.read(self.__path, self.__codec):
+            if kind == 'u':
+                update_id = value['update_id']
+                self.__incomplete[update_id] = value
+                self.__last_id = max(self.__last_id, update_id)
+            elif kind == 'd':
+                self.__incomplete.pop(value, None)
+            elif kind == 'o':
+                self.__last_id = max(self.__last_id, value)
+
+        if self.__compact:
+            self.__rewrite()
+        else:
+            self.__cut_broken_record()
+            self.__file = open(self.__path, 'ab')
+
+        if self.__incomplete:
+            logger.info('recovered %s unhandled updates from the journal', len(self.__incomplete))
+        return list(self.__incomplete.values())
+
+    def received(self, update):
+        """Records a received update, given as a dict"""
+        update_id = update['update_id']
+        self.__incomplete[update_id] = update
+        self.__last_id = max(self.__last_id, update_id)
+        self.__write({'u': update})
+
+    def done(self, update_id):
+        """Records that the update with given id was handled"""
+        if self.__incomplete.pop(update_id, None) is not None:
+            self.__write({'d': update_id})
+
+    async def sync(self):
+        """Makes everything written so far durable, the fsync itself is done in an executor"""
+        if self.__compact and self.__records >= self.compact_every:
+            self.__rewrite()
+            return
+        self.__file.flush()
+        await asyncio.get_event_loop().run_in_executor(None, os.fsync, self.__file.fileno())
+
+    def close(self):
+        """Makes the journal durable and closes it, later records are ignored"""
+        if self.__file is not None:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__file.close()
+            self.__file = None
+
+    @staticmethod
+    def read(path, codec=None):
+        """Yields (kind, value) pairs of the records in the journal at given path, skipping broken ones"""
+        codec = codec or default_codec()
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = codec.loads(line)
+                except ValueError:
+                    # only the last line can be broken, when the process died while writing it
+                    logger.warning('skipping a broken journal record')
+                    continue
+                yield from record.items()
+
+    @staticmethod
+    def updates(path, codec=None):
+        """Yields all of the updates recorded in the journal at given path"""
+        for kind, value in Journal.read(path, codec):
+            if kind == 'u':
+                yield value
+
+    def __write(self, record):
+        if self.__file is None:
+            # a handler finished after the journal was closed, it is handled again on the next start
+            return
+        self.__file.write(self.__codec.dumps(record) + b'\n')
+        self.__records += 1
+
+    def __cut_broken_record(self):
+        # otherwise the next record would be appended to the line of the broken one and skipped with it
+        if not os.path.exists(self.__path):
+            return
+        with open(self.__path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            size = complete_size(f, end)
+            if size != end:
+                logger.warning('cutting a broken record of %s bytes off the end of the journal', end - size)
+                f.truncate(size)
+
+    def __rewrite(self):
+        if self.__file is not None:
+            self.__file.close()
+        tmp = self.__path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.__codec.dumps({'o': self.__last_id}) + b'\n')
+            for update in self.__incomplete.values():
+                f.write(self.__codec.dumps({'u': update}) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.__path)
+        self.__records = 0
+        self.__file = open(self.__path, 'ab')
+
+
+def complete_size(f, end, chunk_size=65536):
+    """Returns the size of the file up to the end of its last complete line"""
+    position = end
+    while position > 0:
+        start = max(0, position - chunk_size)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        position = start
+    return 0
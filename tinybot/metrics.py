@@ -0,0 +1,267 @@
+import asyncio
+import hmac
+import math
+from bisect import bisect_left
+from collections import defaultdict
+from ipaddress import ip_address
+
+from aiohttp import web
+
+import tinybot.logger as tlogger
+
+__all__ = ('Histogram', 'Metrics', 'serve_metrics')
+
+logger = tlogger.get('tinybot.metrics')
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+BATCH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Counts the observed values in buckets by their upper bounds, like a Prometheus histogram"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns (upper bound, number of values not greater than it) pairs, the last bound is infinity"""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket the p-th percentile falls in, None if there were no values"""
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+    @property
+    def stats(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class Metrics:
+    """
+    Latencies and counters of a bot: how long its handlers take, how long its
+    API calls take and how often they fail, how long updates wait in the
+    dispatcher and how big getUpdates batches are. Recording is a couple of
+    dict lookups and a bisect, so it is always on. Updates dropped before the
+    dispatcher (see `tinybot.coalesce.Coalescer`) are counted by the reason.
+
+    The current values of gauges, such as the number of updates in flight,
+    are read from the functions registered with `gauge` when rendered.
+    """
+
+    def __init__(self, bot=None):
+        """:param bot: name of the bot, added as a label to all of the rendered samples"""
+        self.bot = bot
+        self.handler_latency = defaultdict(Histogram)
+        self.handler_errors = defaultdict(int)
+        self.request_latency = defaultdict(Histogram)
+        self.request_errors = defaultdict(int)
+        self.request_retries = defaultdict(int)
+        self.queue_wait = Histogram()
+        self.batch_size = Histogram(BATCH_BUCKETS)
+        self.dropped_updates = defaultdict(int)
+        self.__gauges = {}
+
+    def observe_handler(self, update_type, seconds, failed=False):
+        self.handler_latency[update_type].observe(seconds)
+        if failed:
+            self.handler_errors[update_type] += 1
+
+    def observe_request(self, method, seconds, error_code=None):
+        self.request_latency[method].observe(seconds)
+        if error_code is not None:
+            self.request_errors[method, error_code] += 1
+
+    def count_retry(self, method):
+        self.request_retries[method] += 1
+
+    def observe_queue_wait(self, seconds):
+        self.queue_wait.observe(seconds)
+
+    def observe_batch(self, size):
+        self.batch_size.observe(size)
+
+    def count_dropped(self, reason):
+        self.dropped_updates[reason] += 1
+
+    def gauge(self, name, func, help_text=''):
+        """Registers a gauge whose value is the result of calling `func`, replacing one with the same name"""
+        self.__gauges[name] = (func, help_text)
+
+    def remove_gauge(self, name):
+        self.__gauges.pop(name, None)
+
+    @property
+    def stats(self):
+        """All of the metrics as a dict, histograms summarized by their count, sum and percentiles"""
+        return {
+            'handlers': {k: dict(h.stats, errors=self.handler_errors[k]) for k, h in self.handler_latency.items()},
+            'requests': {k: dict(h.stats, retries=self.request_retries[k],
+                                 errors={code: n for (m, code), n in self.request_errors.items() if m == k})
+                         for k, h in self.request_latency.items()},
+            'queue_wait': self.queue_wait.stats,
+            'batch_size': self.batch_size.stats,
+            'dropped_updates': dict(self.dropped_updates),
+            'gauges': {name: func() for name, (func, _) in self.__gauges.items()},
+        }
+
+    def render(self):
+        """Renders the metrics in Prometheus text exposition format"""
+        lines = []
+
+        def labels(**kwargs):
+            if self.bot is not None:
+                kwargs = dict(bot=self.bot, **kwargs)
+            if not kwargs:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in kwargs.items())
+
+        def header(name, kind, help_text):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def histogram(name, histogram, **kwargs):
+            for bound, total in histogram.cumulative():
+                lines.append('%s_bucket%s %s' % (name, labels(**kwargs, le=format_bound(bound)), total))
+            lines.append('%s_sum%s %r' % (name, labels(**kwargs), histogram.sum))
+            lines.append('%s_count%s %s' % (name, labels(**kwargs), histogram.count))
+
+        header('tinybot_handler_seconds', 'histogram', 'Time spent handling updates, by update type')
+        for update_type, h in self.handler_latency.items():
+            histogram('tinybot_handler_seconds', h, update_type=update_type)
+
+        header('tinybot_handler_errors_total', 'counter', 'Updates whose handler failed, by update type')
+        for update_type, n in self.handler_errors.items():
+            lines.append('tinybot_handler_errors_total%s %s' % (labels(update_type=update_type), n))
+
+        header('tinybot_request_seconds', 'histogram', 'Duration of API calls including retries, by method')
+        for method, h in self.request_latency.items():
+            histogram('tinybot_request_seconds', h, method=method)
+
+        header('tinybot_request_errors_total', 'counter', 'Failed API calls, by method and error code')
+        for (method, code), n in self.request_errors.items():
+            lines.append('tinybot_request_errors_total%s %s' % (labels(method=method, code=code), n))
+
+        header('tinybot_request_retries_total', 'counter', 'API calls retried after a flood limit error, by method')
+        for method, n in self.request_retries.items():
+            lines.append('tinybot_request_retries_total%s %s' % (labels(method=method), n))
+
+        header('tinybot_queue_wait_seconds', 'histogram', 'Time updates waited in the dispatcher before handling')
+        histogram('tinybot_queue_wait_seconds', self.queue_wait)
+
+        header('tinybot_getupdates_batch_size', 'histogram', 'Number of updates returned by getUpdates')
+        histogram('tinybot_getupdates_batch_size', self.batch_size)
+
+        header('tinybot_updates_dropped_total', 'counter', 'Updates dropped before the dispatcher, by reason')
+        for reason, n in self.dropped_updates.items():
+            lines.append('tinybot_updates_dropped_total%s %s' % (labels(reason=reason), n))
+
+        for name, (func, help_text) in self.__gauges.items():
+            header(name, 'gauge', help_text)
+            lines.append('%s%s %r' % (name, labels(), func()))
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def is_local(request):
+    try:
+        return request.remote is not None and ip_address(request.remote).is_loopback
+    except ValueError:
+        return False
+
+
+def query_number(request, name, default, convert):
+    try:
+        value = convert(request.query.get(name, default))
+    except ValueError:
+        value = None
+    if value is None or not math.isfinite(value) or value <= 0:
+        raise web.HTTPBadRequest(text='%s should be a finite positive number' % name)
+    return value
+
+
+async def serve_metrics(metrics, port, profiler=None, control_token=None):
+    """
+    Serves the metrics in Prometheus text format at '/metrics' on given port until cancelled.
+    `metrics` is either a Metrics or a function returning the text to serve.
+
+    With a `tinybot.profiling.Profiler` given, it is controlled by POST (to start) and DELETE (to stop)
+    requests to '/profile?updates=n' and '/slow?threshold=seconds'. Those are only answered to requests
+    from localhost, or, with a `control_token`, to requests with an 'Authorization: Bearer <token>' header
+    """
+    render = metrics.render if isinstance(metrics, Metrics) else metrics
+
+    def check_access(request):
+        if control_token is not None:
+            authorization = request.headers.get('Authorization', '')
+            if hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + control_token).encode('utf-8')):
+                return
+        if not is_local(request):
+            raise web.HTTPForbidden()
+
+    async def handle_get(request):
+        return web.Response(body=render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def handle_profile(request):
+        check_access(request)
+        if request.method == 'POST':
+            profiler.start_profile(query_number(request, 'updates', 1000, int))
+            return web.json_response({'profiling': profiler.profiling})
+        return web.json_response({'path': profiler.stop_profile()})
+
+    async def handle_slow(request):
+        check_access(request)
+        if request.method == 'POST':
+            profiler.start_slow_log(query_number(request, 'threshold', 1.0, float))
+        else:
+            profiler.stop_slow_log()
+        return web.json_response({'threshold': profiler.slow_threshold})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_get)
+    if profiler is not None:
+        for method in ('POST', 'DELETE'):
+            app.router.add_route(method, '/profile', handle_profile)
+            app.router.add_route(method, '/slow', handle_slow)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, port=port).start()
+        logger.info('serving metrics at port %s', port)
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,197 @@
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import signal
+from collections import deque
+from io import StringIO
+from time import monotonic, strftime, time
+
+import tinybot.logger as tlogger
+
+__all__ = ('Profiler', 'watch_signals', 'unwatch_signals')
+
+logger = tlogger.get('tinybot.profiling')
+
+LAG_INTERVAL = 0.05
+
+
+class Profiler:
+    """
+    Profiling of a running bot, switched on and off at runtime:
+     - `start_profile` records a cProfile profile of the event loop thread until the next n updates are handled,
+       then writes it to a .prof file for `pstats` or snakeviz
+     - `start_slow_log` logs the updates whose handler took longer than a threshold, with the longest
+       time the event loop was blocked for while they were handled, to a JSON lines file
+
+    While either of them is on, a task measures how late the event loop wakes it up, which is the time
+    the loop was blocked by something. When both are off, the only cost is checking `active` per update.
+    Sync handlers run by the executors are not in the profile, only the waiting for them is.
+    """
+
+    def __init__(self, name, directory='profiles'):
+        """
+        :param name: name of the bot, the output files are named by it
+        :param directory: directory where the output files are written
+        """
+        self.name = name
+        self.directory = directory
+        self.active = False
+        """Whether profiling or slow update logging is on, `observe` should only be called when it is"""
+        self.__profile = None
+        self.__profile_left = 0
+        self.__slow_threshold = None
+        self.__lags = deque(maxlen=4096)
+        self.__monitor = None
+
+    @property
+    def profiling(self):
+        return self.__profile is not None
+
+    @property
+    def slow_threshold(self):
+        """Handler time above which updates are logged, None when slow update logging is off"""
+        return self.__slow_threshold
+
+    def start_profile(self, updates=1000):
+        """Starts profiling until the next `updates` updates are handled, does nothing if it is already on"""
+        if self.__profile is not None:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # e.g. another bot on the same loop is being profiled already
+            logger.warning('can not profile %s, %s', self.name, e)
+            return
+        logger.info('profiling %s for the next %s updates', self.name, updates)
+        self.__profile_left = updates
+        self.__profile = profile
+        self.__toggled()
+
+    def stop_profile(self):
+        """Stops profiling right away and writes the profile, returns the path of the written file or None"""
+        profile, self.__profile = self.__profile, None
+        if profile is None:
+            return None
+        profile.disable()
+        self.__toggled()
+        path = self.__path('%s-%s.prof' % (self.name, strftime('%Y%m%d-%H%M%S')))
+        profile.dump_stats(path)
+
+        summary = StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(15)
+        logger.info('wrote the profile of %s to %s, top of it by cumulative time:\n%s', self.name, path,
+                    summary.getvalue())
+        return path
+
+    def start_slow_log(self, threshold=1.0):
+        """Starts logging the updates whose handler takes longer than `threshold` seconds"""
+        logger.info('logging the updates of %s slower than %s seconds', self.name, threshold)
+        self.__slow_threshold = threshold
+        self.__toggled()
+
+    def stop_slow_log(self):
+        self.__slow_threshold = None
+        self.__toggled()
+
+    def observe(self, update_type, update, seconds):
+        """Called with each handled update while `active`"""
+        if self.__slow_threshold is not None and seconds > self.__slow_threshold:
+            self.__log_slow(update_type, update, seconds)
+        if self.__profile is not None:
+            self.__profile_left -= 1
+            if self.__profile_left <= 0:
+                self.stop_profile()
+
+    def close(self):
+        """Writes the profile if it is on and stops slow update logging"""
+        self.stop_profile()
+        self.stop_slow_log()
+
+    def __toggled(self):
+        self.active = self.__profile is not None or self.__slow_threshold is not None
+        if self.active and self.__monitor is None:
+            self.__monitor = asyncio.ensure_future(self.__measure_lag())
+        elif not self.active and self.__monitor is not None:
+            self.__monitor.cancel()
+            self.__monitor = None
+            self.__lags.clear()
+
+    async def __measure_lag(self):
+        while True:
+            expected = monotonic() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            now = monotonic()
+            self.__lags.append((now, now - expected))
+
+    def __loop_lag(self, start, end):
+        """Returns the longest time the loop was blocked for between start and end"""
+        # a lag is measured when the loop is unblocked, so it can be measured a bit after the end
+        return max((lag for t, lag in self.__lags if start <= t <= end + LAG_INTERVAL), default=0.0)
+
+    def __log_slow(self, update_type, update, seconds):
+        end = monotonic()
+        lag = self.__loop_lag(end - seconds, end)
+        data = update.get(update_type)
+        chat = data.get('chat') if hasattr(data, 'get') else None
+        logger.warning('\'%s\' update %s took %.3f seconds, the event loop was blocked for up to %.3f seconds',
+                       update_type, update.get('update_id'), seconds, lag)
+        record = {
+            'time': time(),
+            'update_id': update.get('update_id'),
+            'type': update_type,
+            'chat_id': chat.get('id') if chat is not None else None,
+            'seconds': round(seconds, 6),
+            'loop_lag': round(lag, 6),
+        }
+        try:
+            with open(self.__path('%s-slow.jsonl' % self.name), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logger.warning('failed to write the slow update log, %s', e)
+
+    def __path(self, filename):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, filename)
+
+
+watched = {}
+
+
+def toggle_profiles():
+    for profiler, (updates, _) in list(watched.items()):
+        if profiler.profiling:
+            profiler.stop_profile()
+        else:
+            profiler.start_profile(updates)
+
+
+def toggle_slow_logs():
+    for profiler, (_, threshold) in list(watched.items()):
+        if profiler.slow_threshold is not None:
+            profiler.stop_slow_log()
+        else:
+            profiler.start_slow_log(threshold)
+
+
+def watch_signals(profiler, updates=1000, threshold=1.0):
+    """
+    Makes SIGUSR1 start profiling the next `updates` updates (or stop and write the profile if it is on),
+    and SIGUSR2 toggle logging the updates slower than `threshold` seconds. The signals toggle all of the
+    watched profilers, such as the ones of all of the bots of a `Host`
+    """
+    if not watched:
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGUSR1, toggle_profiles)
+        loop.add_signal_handler(signal.SIGUSR2, toggle_slow_logs)
+    watched[profiler] = (updates, threshold)
+
+
+def unwatch_signals(profiler):
+    watched.pop(profiler, None)
+    if not watched:
+        loop = asyncio.get_event_loop()
+        loop.remove_signal_handler(signal.SIGUSR1)
+        loop.remove_signal_handler(signal.SIGUSR2)
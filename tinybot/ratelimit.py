@@ -0,0 +1,139 @@
+import asyncio
+from time import monotonic
+
+from tinybot.responsecache import normalize_id
+
+__all__ = ('TokenBucket', 'RateLimiter')
+
+
+class TokenBucket:
+    """
+    Token bucket which hands out reservations instead of blocking, so the
+    callers are served in the order they asked and each one just sleeps
+    for its own delay.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: number of tokens added each second
+        :param capacity: maximum number of tokens, e.g. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__stamp = monotonic()
+        self.__blocked_until = 0
+
+    @property
+    def idle(self):
+        """True if the bucket is full, so forgetting it changes nothing"""
+        now = monotonic()
+        return now >= self.__blocked_until and self.__tokens + (now - self.__stamp) * self.rate >= self.capacity
+
+    def reserve(self):
+        """Takes a token and returns the number of seconds to wait before using it"""
+        now = monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__stamp) * self.rate) - 1
+        self.__stamp = now
+        delay = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        return max(delay, self.__blocked_until - now)
+
+    def delay(self):
+        """Returns the number of seconds until the bucket is unblocked, without taking a token"""
+        return max(0, self.__blocked_until - monotonic())
+
+    def block(self, seconds):
+        self.__blocked_until = max(self.__blocked_until, monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Keeps the outgoing messages within Telegram limits: a global bucket for
+    all of the messages sent, and a bucket per chat which is more strict for
+    groups and channels (negative or '@username' chat ids). Only the methods
+    sending messages are counted (see `limits`), the other ones, such as
+    getChatMember, editMessageText or sendChatAction, only wait while the limiter is blocked.
+
+    When Telegram answers with 429 anyway, the bucket which caused it is
+    blocked for the `retry_after` seconds and the request is retried.
+    """
+
+    max_retries = 5
+    """Number of times a request is retried after a 429 response before it fails"""
+
+    prune_threshold = 10000
+    """Number of chat buckets after which the idle ones are forgotten"""
+
+    limited_methods = frozenset((
+        'sendMessage', 'sendPhoto', 'sendAudio', 'sendDocument', 'sendVideo', 'sendAnimation', 'sendVoice',
+        'sendVideoNote', 'sendPaidMedia', 'sendMediaGroup', 'sendLocation', 'sendVenue', 'sendContact',
+        'sendPoll', 'sendChecklist', 'sendDice', 'sendSticker', 'sendInvoice', 'sendGame',
+        'copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages',
+    ))
+    """Names of the methods which are counted, see `limits`"""
+
+    def __init__(self, global_rate=30, chat_rate=1, group_rate=20 / 60):
+        """
+        :param global_rate: requests per second to all chats
+        :param chat_rate: requests per second to a single private chat
+        :param group_rate: requests per second to a single group or channel
+        """
+        self.__global = TokenBucket(global_rate, max(1, global_rate))
+        self.__chat_rate = chat_rate
+        self.__group_rate = group_rate
+        self.__chats = {}
+        self.waits = 0
+        self.wait_time = 0
+        self.max_wait = 0
+        self.retries = 0
+
+    @property
+    def stats(self):
+        """Waiting statistics, total wait time and such is in seconds"""
+        return {
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait,
+            'retries': self.retries,
+            'chats': len(self.__chats),
+        }
+
+    def limits(self, method):
+        """Whether the calls of given method are counted, that is, whether it sends a message"""
+        return method in self.limited_methods
+
+    async def acquire(self, chat_id=None):
+        """
+        Waits until a request to given chat is allowed. Requests which are not
+        sent to a chat are not counted, they only wait while the limiter is
+        blocked by a 429 response
+        """
+        if chat_id is None:
+            await self.__wait(self.__global.delay())
+            return
+        await self.__wait(self.__bucket(chat_id).reserve())
+        await self.__wait(self.__global.reserve())
+
+    def block(self, seconds, chat_id=None):
+        """Blocks requests to given chat (or all of the requests) for given number of seconds"""
+        self.retries += 1
+        (self.__global if chat_id is None else self.__bucket(chat_id)).block(seconds)
+
+    def __bucket(self, chat_id):
+        # '12345' is the same private chat as 12345
+        chat_id = normalize_id(chat_id)
+        bucket = self.__chats.get(chat_id)
+        if bucket is None:
+            if len(self.__chats) >= self.prune_threshold:
+                self.__chats = {k: v for k, v in self.__chats.items() if not v.idle}
+            group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = self.__chats[chat_id] = TokenBucket(self.__group_rate if group else self.__chat_rate)
+        return bucket
+
+    async def __wait(self, delay):
+        if delay <= 0:
+            return
+        self.waits += 1
+        self.wait_time += delay
+        self.max_wait = max(self.max_wait, delay)
+        await asyncio.sleep(delay)
@@ -0,0 +1,189 @@
+import asyncio
+from collections import OrderedDict, defaultdict
+from time import monotonic
+
+import tinybot.logger as tlogger
+from tinybot.webapi import DynamicDictObject
+
+__all__ = ('ResponseCache',)
+
+logger = tlogger.get('tinybot.responsecache')
+
+# methods which change a chat or its members, their chat is invalidated after they succeed
+MUTATING_PREFIXES = ('ban', 'unban', 'restrict', 'promote', 'setChat', 'deleteChat', 'leaveChat',
+                     'pinChat', 'unpinChat', 'approveChat', 'declineChat')
+
+# fields of service messages telling that the chat or its members changed
+CHANGING_FIELDS = ('new_chat_members', 'left_chat_member', 'new_chat_title', 'new_chat_photo',
+                   'delete_chat_photo', 'pinned_message', 'migrate_to_chat_id')
+
+
+class ResponseCache:
+    """
+    Read-through cache of the results of the Bot API methods which only read,
+    keyed by the method and its arguments, each method with its own time to live.
+
+    Concurrent identical calls are sent once, all of them getting the result of
+    that one call. Errors are not cached. The entries of a chat are dropped when
+    an update tells that the chat or its members changed (see `invalidate_for`),
+    and when the bot itself calls a method changing it, such as banChatMember.
+    """
+
+    default_ttls = {
+        'getMe': 3600,
+        'getChat': 60,
+        'getChatMember': 30,
+        'getChatAdministrators': 60,
+        'getChatMemberCount': 60,
+        'getMyCommands': 3600,
+        'getStickerSet': 3600,
+    }
+    """Seconds the results of the cached methods are kept for, methods not in here are not cached"""
+
+    invalidating_updates = ('chat_member', 'my_chat_member')
+    """Update types which drop the entries of their chat"""
+
+    def __init__(self, ttls=None, capacity=1024):
+        """
+        :param ttls: dict of the method names to the seconds their results are kept for, `default_ttls` if None
+        :param capacity: maximum number of kept results, least recently used ones are dropped first
+        """
+        self.__ttls = dict(ttls) if ttls is not None else dict(self.default_ttls)
+        self.__capacity = capacity
+        self.__entries = OrderedDict()
+        self.__chats = defaultdict(set)
+        self.__pending = {}
+        self.__epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def ttls(self):
+        return self.__ttls
+
+    @property
+    def stats(self):
+        return {'size': len(self.__entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    async def fetch(self, method, kwargs, call):
+        """
+        Returns the cached result of calling given method with given arguments,
+        or awaits `call()` for it, sharing the call with the concurrent identical ones
+        """
+        ttl = self.__ttls.get(method)
+        if ttl is None:
+            result = await call()
+            if method.startswith(MUTATING_PREFIXES) and 'chat_id' in kwargs:
+                self.invalidate(kwargs['chat_id'])
+            return result
+
+        key = make_key(method, kwargs)
+        if key is None:
+            return await call()
+
+        entry = self.__entries.get(key)
+        if entry is not None:
+            if entry[0] > monotonic():
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return entry[1]
+            self.__remove(key)
+
+        pending = self.__pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+            # the call this one waited for was cancelled, so it is made again
+            return await self.fetch(method, kwargs, call)
+
+        self.misses += 1
+        future = self.__pending[key] = asyncio.get_event_loop().create_future()
+        epoch = self.__epoch
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # marks the exception as retrieved, there might be no one else waiting for it
+            future.exception()
+            raise
+        finally:
+            del self.__pending[key]
+
+        future.set_result(result)
+        # something was invalidated while the call was made, the result might be stale already
+        if epoch == self.__epoch:
+            self.__put(key, monotonic() + ttl, result)
+        return result
+
+    def invalidate(self, chat_id=None):
+        """Drops the entries of the chat with given id, or all of them if it is None"""
+        self.__epoch += 1
+        if chat_id is None:
+            self.__entries.clear()
+            self.__chats.clear()
+            return
+        for key in self.__chats.pop(normalize_id(chat_id), ()):
+            self.__entries.pop(key, None)
+
+    def invalidate_for(self, update):
+        """Drops the entries of the chat given update is from, if the update tells that the chat has changed"""
+        for name, data in update.items():
+            if not isinstance(data, DynamicDictObject) or 'chat' not in data:
+                continue
+            if name in self.invalidating_updates or any(f in data for f in CHANGING_FIELDS):
+                self.invalidate(data.chat.get('id'))
+
+    def __put(self, key, expires, result):
+        self.__entries[key] = (expires, result)
+        self.__entries.move_to_end(key)
+        chat_id = dict(key[1]).get('chat_id')
+        if chat_id is not None:
+            self.__chats[chat_id].add(key)
+        while len(self.__entries) > self.__capacity:
+            self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key):
+        self.__entries.pop(key, None)
+        chat_id = dict(key[1]).get('chat_id')
+        keys = self.__chats.get(chat_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.__chats[chat_id]
+
+
+def normalize_id(value):
+    """Chat and user ids might be given as ints or as strings, both are the same id"""
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        return int(value)
+    return value
+
+
+def make_key(method, kwargs):
+    """Returns a hashable key of given call, None if its arguments can not be made hashable"""
+    items = []
+    for k, v in kwargs.items():
+        if isinstance(v, DynamicDictObject):
+            v = v.unwrap()
+        if isinstance(v, (dict, list)):
+            v = repr(v)
+        elif k.endswith('_id'):
+            v = normalize_id(v)
+        try:
+            hash(v)
+        except TypeError:
+            return None
+        items.append((k, v))
+    items.sort()
+    return method, tuple(items)
@@ -0,0 +1,212 @@
+import re
+from inspect import signature
+
+__all__ = ('command', 'prefix', 'regex', 'callback', 'Router')
+
+ROUTES_ATTRIBUTE = 'tinybot_routes'
+
+# '/command' or '/command@bot_username', followed by the arguments
+COMMAND = re.compile(r'/(\w+)(?:@(\w+))?(?:\s+|$)')
+
+
+def routed(kind, *values):
+    def decorator(func):
+        routes = func.__dict__.setdefault(ROUTES_ATTRIBUTE, [])
+        routes.extend((kind, v) for v in values)
+        return func
+
+    return decorator
+
+
+def command(*names):
+    """
+    Routes messages starting with any of given commands (without the slash) to the decorated method.
+    Commands are case-insensitive, and ones addressed to other bots as '/command@other_bot'
+    are ignored when `Bot.username` is set.
+    If the method takes an argument after `api`, it is given the text after the command
+    """
+    return routed('command', *(n.lstrip('/').lower() for n in names))
+
+
+def prefix(*prefixes):
+    """
+    Routes messages whose text starts with any of given prefixes to the decorated method.
+    The longest matching prefix wins. If the method takes an argument after `api`,
+    it is given the text after the prefix
+    """
+    return routed('prefix', *prefixes)
+
+
+def regex(*patterns):
+    """
+    Routes messages whose text matches any of given patterns at its start (as `re.match` does)
+    to the decorated method, prepend '.*' to match anywhere. The first declared matching pattern wins.
+    If the method takes an argument after `api`, it is given the `re.Match` object
+    """
+    return routed('regex', *patterns)
+
+
+def callback(*patterns):
+    """Same as `regex`, but for the data of callback queries"""
+    return routed('callback', *patterns)
+
+
+class PatternSet:
+    """
+    Patterns matched in the order they were added, with the first matching one winning.
+    When possible, they are compiled into one alternation, so finding the winner is one regex pass
+    """
+
+    def __init__(self, patterns):
+        """:param patterns: list of (pattern, target) pairs"""
+        self.__patterns = [(re.compile(p), target) for p, target in patterns]
+        self.__combined, self.__groups = combine([p for p, _ in self.__patterns])
+
+    def __bool__(self):
+        return bool(self.__patterns)
+
+    def match(self, text):
+        """Returns (match, target) of the first pattern matching given text, or None"""
+        if self.__combined is not None:
+            m = self.__combined.match(text)
+            if m is None:
+                return None
+            pattern, target = self.__patterns[self.__groups[m.lastindex]]
+            # matched again to give the handler a match with the groups of its own pattern
+            return pattern.match(text), target
+        for pattern, target in self.__patterns:
+            m = pattern.match(text)
+            if m is not None:
+                return m, target
+        return None
+
+
+def combine(patterns):
+    """
+    Joins the patterns into one alternation with a capturing group around each of them.
+    Returns the combined pattern and a dict of the group numbers of those groups to the pattern indices,
+    or (None, None) if the patterns can not be joined without changing their meaning
+    """
+    if not patterns:
+        return None, None
+    groups, number, parts = {}, 1, []
+    for i, pattern in enumerate(patterns):
+        # numbered back references would point to other groups, and flags can not be mixed
+        if pattern.flags & ~re.UNICODE or re.search(r'\\\d|\(\?P=|\(\?\(', pattern.pattern):
+            return None, None
+        groups[number] = i
+        number += pattern.groups + 1
+        parts.append('(%s)' % pattern.pattern)
+    try:
+        # since it has only the outer group of each alternative as the last one closed, lastindex tells the pattern
+        return re.compile('|'.join(parts)), groups
+    except re.error:
+        # e.g. the same group name in two of the patterns
+        return None, None
+
+
+class Router:
+    """
+    Routes of a bot class, compiled from its decorated methods when the class is created:
+    a dict of the commands, one regex of all the prefixes longest first, and the
+    message and callback patterns joined into one regex each, so finding the method for an
+    update does not depend on the number of routes.
+
+    Routed messages go to the routed method, other ones go to `handle_message` if there is one.
+    """
+
+    def __init__(self, cls):
+        methods = {}
+        for klass in reversed(cls.__mro__):
+            for name in vars(klass):
+                methods.setdefault(name, None)
+
+        commands, prefixes, patterns, callbacks = {}, [], [], []
+        self.__extra = {}
+        for name in methods:
+            func = getattr(cls, name, None)
+            routes = getattr(func, ROUTES_ATTRIBUTE, None)
+            if not routes:
+                continue
+            # self, data, api and then the optional extra argument
+            self.__extra[name] = len(signature(func).parameters) > 3
+            for kind, value in routes:
+                if kind == 'command':
+                    commands.setdefault(value, name)
+                elif kind == 'prefix':
+                    prefixes.append((value, name))
+                elif kind == 'regex':
+                    patterns.append((value, name))
+                elif kind == 'callback':
+                    callbacks.append((value, name))
+
+        self.__commands = commands
+        prefixes.sort(key=lambda p: -len(p[0]))
+        self.__prefixes = PatternSet([(re.escape(p), name) for p, name in prefixes])
+        self.__patterns = PatternSet(patterns)
+        self.__callbacks = PatternSet(callbacks)
+        self.username = getattr(cls, 'username', None)
+        """Username of the bot, commands addressed to other bots are not routed when it is set"""
+
+    @property
+    def update_types(self):
+        """Update types which have routes"""
+        types = []
+        if self.__commands or self.__prefixes or self.__patterns:
+            types.append('message')
+        if self.__callbacks:
+            types.append('callback_query')
+        return types
+
+    @property
+    def methods(self):
+        """Names of the routed methods"""
+        return list(self.__extra)
+
+    def route(self, update_type, data):
+        """
+        Returns the name of the method given update should be handled by and the tuple of
+        extra arguments for it, or None if there is no route for the update
+        """
+        if update_type == 'message':
+            target = self.route_text(data.get('text') or data.get('caption'))
+        elif update_type == 'callback_query':
+            target = self.route_callback(data.get('data'))
+        else:
+            return None
+        if target is None:
+            return None
+        name, extra = target
+        return name, (extra,) if self.__extra[name] else ()
+
+    def route_text(self, text):
+        if not isinstance(text, str):
+            return None
+        if self.__commands and text.startswith('/'):
+            m = COMMAND.match(text)
+            if m is not None:
+                name, mention = m.groups()
+                if mention is None or self.username is None or mention.lower() == self.username.lower():
+                    target = self.__commands.get(name.lower())
+                    if target is not None:
+                        return target, text[m.end():]
+        if self.__prefixes:
+            found = self.__prefixes.match(text)
+            if found is not None:
+                m, target = found
+                return target, text[m.end():]
+        if self.__patterns:
+            found = self.__patterns.match(text)
+            if found is not None:
+                m, target = found
+                return target, m
+        return None
+
+    def route_callback(self, data):
+        if not isinstance(data, str) or not self.__callbacks:
+            return None
+        found = self.__callbacks.match(data)
+        if found is None:
+            return None
+        m, target = found
+        return target, m
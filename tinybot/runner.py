@@ -13,7 +13,7 @@ def run(bot_cls):
 
     parser = argparse.ArgumentParser(description=bot_cls.description)
     subparsers = parser.add_subparsers(
-        metavar='type{longpoll, webhook}', dest='type',
+        metavar='type{longpoll, webhook, replay}', dest='type',
         help='Technique used for listening to updates.\n'
              'It is recommended to call the program with arguments \'TYPE -h\' for type-specific help.'
     )
@@ -52,6 +52,17 @@ def run(bot_cls):
     webhook_parser.add_argument('token', help='The token of given bot')
     webhook_parser.add_argument('port', type=ranged_int(0, 65535), help='Local port to listen at')
     webhook_parser.add_argument('url', help='URL which will be set as the webhook link.')
+    webhook_parser.add_argument('-w', '--workers', type=ranged_int(1, 256), default=1,
+                                help='Number of server processes listening at the same port. '
+                                     'Integer in range [1, 256]. Defaults to 1')
+
+    replay_parser = subparsers.add_parser(
+        'replay',
+        description='This mode feeds the updates recorded in an update journal through the handlers '
+                    'as fast as they are handled, and exits. Note that the handlers still make their requests.'
+    )
+    replay_parser.add_argument('token', help='The token of given bot')
+    replay_parser.add_argument('journal', help='Path of the journal recorded in longpoll mode')
 
     args = parser.parse_args()
 
@@ -63,7 +74,9 @@ def run(bot_cls):
     if args.type == 'longpoll':
         bot_cls.launch_longpoll(args.timeout)
     elif args.type == 'webhook':
-        bot_cls.launch_webhook(args.url, args.port)
+        bot_cls.launch_webhook(args.url, args.port, args.workers)
+    elif args.type == 'replay':
+        bot_cls.launch_replay(args.journal)
 
 
 def debug_run(longpoll_timeout=30, token=None, tokenfile=None, tokenenv=None):
@@ -0,0 +1,68 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+__all__ = ('ConnectionStats', 'create_session')
+
+
+class ConnectionStats:
+    """Counts the connections made and reused by the sessions it is attached to"""
+
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self.trace_config = TraceConfig()
+        self.trace_config.on_connection_create_end.append(self.__created)
+        self.trace_config.on_connection_reuseconn.append(self.__reused)
+        self.trace_config.on_dns_cache_hit.append(self.__dns_hit)
+        self.trace_config.on_dns_cache_miss.append(self.__dns_miss)
+
+    @property
+    def reuse_ratio(self):
+        """Part of the requests which were sent over an already open connection"""
+        total = self.created + self.reused
+        return self.reused / total if total else 0
+
+    @property
+    def stats(self):
+        return {
+            'created': self.created,
+            'reused': self.reused,
+            'reuse_ratio': self.reuse_ratio,
+            'dns_hits': self.dns_hits,
+            'dns_misses': self.dns_misses,
+        }
+
+    async def __created(self, session, context, params):
+        self.created += 1
+
+    async def __reused(self, session, context, params):
+        self.reused += 1
+
+    async def __dns_hit(self, session, context, params):
+        self.dns_hits += 1
+
+    async def __dns_miss(self, session, context, params):
+        self.dns_misses += 1
+
+
+def create_session(cls, limit=None, timeout=None):
+    """
+    Creates a session with the connection pool configured by the bot class.
+
+    :param limit: overrides the pool size, e.g. 1 for the session used for longpolling
+    :param timeout: total timeout of a request in seconds, aiohttp default if None
+    """
+    connector = TCPConnector(
+        limit=limit or cls.connection_limit,
+        limit_per_host=limit or cls.connection_limit,
+        keepalive_timeout=cls.keepalive_timeout,
+        use_dns_cache=True,
+        ttl_dns_cache=cls.dns_cache_ttl,
+    )
+    return ClientSession(
+        connector=connector,
+        headers={'User-Agent': cls.full_name, 'Accept': 'application/json'},
+        timeout=ClientTimeout(total=timeout if timeout is not None else 300),
+        trace_configs=[cls.connection_stats.trace_config],
+    )
@@ -0,0 +1,286 @@
+import asyncio
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock, local
+from weakref import WeakValueDictionary
+
+import tinybot.logger as tlogger
+from tinybot.codec import default_codec
+from tinybot.responsecache import normalize_id
+
+__all__ = ('State', 'StateStore', 'SQLiteBackend')
+
+logger = tlogger.get('tinybot.state')
+
+
+class SQLiteBackend:
+    """
+    Keeps the states in a SQLite database, one row per chat with its state serialized by the store.
+    Any object with the same `load`, `save` and `close` methods can be used as a backend instead.
+
+    The saves are made with a connection of their own, and each thread loading the states has its own
+    read connection, so in WAL mode the loads do not wait for a batch being written
+    """
+
+    def __init__(self, path):
+        self.__path = os.fspath(path)
+        # the saves are made by the writer thread of the store, so this one is used by a single thread at a time
+        self.__connection = sqlite3.connect(self.__path, check_same_thread=False, isolation_level=None)
+        self.__lock = Lock()
+        self.__local = local()
+        self.__readers = []
+        with self.__lock:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS state (chat_id PRIMARY KEY, data BLOB NOT NULL)')
+
+    def load(self, chat_id):
+        """Returns the serialized state of the chat with given id, None if there is none"""
+        row = self.__reader().execute('SELECT data FROM state WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __reader(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            # closed from the thread closing the backend, not the one it was made by
+            connection = sqlite3.connect(self.__path, check_same_thread=False, isolation_level=None)
+            self.__local.connection = connection
+            with self.__lock:
+                self.__readers.append(connection)
+        return connection
+
+    def save(self, items):
+        """Writes the (chat_id, serialized state) pairs in one transaction, a state of None deletes the row"""
+        with self.__lock:
+            connection = self.__connection
+            connection.execute('BEGIN')
+            try:
+                connection.executemany('INSERT OR REPLACE INTO state (chat_id, data) VALUES (?, ?)',
+                                       [(k, v) for k, v in items if v is not None])
+                connection.executemany('DELETE FROM state WHERE chat_id = ?', [(k,) for k, v in items if v is None])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.__lock:
+            for connection in self.__readers:
+                connection.close()
+            self.__readers.clear()
+            self.__connection.close()
+
+
+class State(dict):
+    """
+    State of a chat, a dict of anything the codec can serialize.
+    Changing it marks it to be written by the next flush of its store.
+    Changes inside of the values, like appending to a list in it, are not noticed, call `changed` after them
+    """
+
+    __slots__ = ('__store', '__key', '__weakref__')
+
+    def __init__(self, store, key, data=()):
+        super().__init__(data)
+        self.__store = store
+        self.__key = key
+
+    def changed(self):
+        """Marks the state to be written by the next flush"""
+        self.__store.mark_dirty(self.__key, self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def __ior__(self, other):
+        result = super().__ior__(other)
+        self.changed()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.changed()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def pop(self, key, *default):
+        result = super().pop(key, *default)
+        self.changed()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self.changed()
+        return result
+
+    def clear(self):
+        super().clear()
+        self.changed()
+
+
+class StateStore:
+    """
+    Per-chat states kept in a bounded LRU in memory, in front of a persistent backend.
+    Getting a state loads it from the backend only when it is not in memory. Changed states
+    are written by `flush` in one batch (`run` flushes periodically), in a thread of its own,
+    so the handlers never wait for a write. Changed states dropped from the LRU are kept
+    until they are written, and the dropped states some handler still holds are given out
+    again instead of being loaded, so there is only one state per chat.
+
+    Can be used from the event loop and from the threads of sync handlers at the same time.
+    """
+
+    def __init__(self, backend, capacity=10000, codec=None):
+        """
+        :param backend: a SQLiteBackend or an object with the same interface, the store closes it
+        :param capacity: maximum number of states kept in memory, not counting the changed ones which are not written yet
+        :param codec: JSON codec the states are serialized with
+        """
+        self.__backend = backend
+        self.__capacity = capacity
+        self.__codec = codec or default_codec()
+        self.__entries = OrderedDict()
+        self.__dirty = set()
+        self.__evicted = {}
+        self.__held = WeakValueDictionary()
+        self.__lock = RLock()
+        self.__writer = ThreadPoolExecutor(1, 'tinybot-state')
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def dirty(self):
+        """Number of the changed states which are not written yet"""
+        return len(self.__dirty)
+
+    @property
+    def stats(self):
+        return {'size': len(self.__entries), 'dirty': len(self.__dirty), 'hits': self.hits,
+                'misses': self.misses, 'written': self.written}
+
+    def get(self, chat_id):
+        """Returns the state of the chat with given id, an empty one if it has none yet"""
+        key = normalize_id(chat_id)
+        with self.__lock:
+            state = self.__entries.get(key)
+            if state is not None:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return state
+            state = self.__found(key)
+            if state is not None:
+                return state
+            self.misses += 1
+
+        # the other threads use the store while this one waits for the backend
+        data = self.__backend.load(key)
+        loaded = self.__codec.loads(data) if data is not None else ()
+
+        with self.__lock:
+            # another thread might have loaded it in the meantime
+            state = self.__found(key)
+            if state is None:
+                state = State(self, key, loaded)
+                self.__held[key] = state
+                self.__add(key, state)
+            return state
+
+    def __found(self, key):
+        state = self.__evicted.pop(key, None)
+        if state is None:
+            state = self.__held.get(key)
+        if state is not None:
+            self.__add(key, state)
+        return state
+
+    def __add(self, key, state):
+        self.__entries[key] = state
+        while len(self.__entries) > self.__capacity:
+            old_key, old_state = self.__entries.popitem(last=False)
+            if old_key in self.__dirty:
+                self.__evicted[old_key] = old_state
+
+    def mark_dirty(self, key, state):
+        with self.__lock:
+            self.__dirty.add(key)
+            # a state changed by a handler which held it after it was dropped from the LRU
+            if key not in self.__entries and key not in self.__evicted:
+                self.__evicted[key] = state
+
+    async def flush(self):
+        """Writes the changed states in one batch"""
+        batch = self.__take_dirty()
+        if not batch:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.__writer, self.__save, batch)
+        except BaseException:
+            self.__written(batch, False)
+            raise
+        self.__written(batch, True)
+
+    async def run(self, interval):
+        """Coroutine which flushes the changed states each `interval` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            # noinspection PyBroadException
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error('failed to write %s changed states, %r', len(self.__dirty), e)
+
+    def close(self):
+        """Writes the changed states right away and closes the backend"""
+        batch = self.__take_dirty()
+        try:
+            if batch:
+                self.__writer.submit(self.__save, batch).result()
+                self.__written(batch, True)
+        finally:
+            self.__writer.shutdown()
+            self.__backend.close()
+
+    def __take_dirty(self):
+        with self.__lock:
+            batch = []
+            for key in self.__dirty:
+                state = self.__entries.get(key)
+                if state is None:
+                    state = self.__evicted.get(key)
+                if state is None:
+                    logger.warning('changed state of chat %s was lost', key)
+                    continue
+                batch.append((key, state))
+            self.__dirty.clear()
+            return batch
+
+    def __save(self, batch):
+        # serialized by the writer thread, each state is copied by a single call
+        # so that the changes made by the handlers meanwhile are not seen half-made
+        dumps = self.__codec.dumps
+        self.__backend.save([(key, dumps(state.copy()) if state else None) for key, state in batch])
+
+    def __written(self, batch, ok):
+        with self.__lock:
+            if not ok:
+                self.__dirty.update(k for k, _ in batch)
+                return
+            self.written += len(batch)
+            for key, _ in batch:
+                # unless it was changed again in the meantime, the evicted state is not needed anymore
+                if key not in self.__dirty:
+                    self.__evicted.pop(key, None)
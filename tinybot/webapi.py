@@ -1,18 +1,33 @@
-import json
-from asyncio import run_coroutine_threadsafe
-from aiohttp import MultipartWriter
+from asyncio import run_coroutine_threadsafe, get_event_loop, wait, Semaphore
+from aiohttp import MultipartWriter, payload
+from collections import namedtuple
+from concurrent import futures
+from contextlib import contextmanager
+from inspect import isasyncgenfunction
 from io import IOBase
+from mimetypes import guess_type
+from mmap import mmap
+from os import PathLike
+from os.path import basename
+from pathlib import PurePath
+from threading import local
+from time import monotonic, perf_counter
 from urllib.parse import urlencode
 
 import tinybot.logger as tlogger
+from tinybot.codec import default_codec
+from tinybot.filecache import content_key
 
 __all__ = (
-    'TelegramAPI', 'BlockingTelegramAPI', 'DynamicDictObject',
+    'TelegramAPI', 'BlockingTelegramAPI', 'DynamicDictObject', 'InputFile', 'DownloadStats',
     'RequestError', 'NoSuchElementError', 'DynamicTypeError'
 )
 
 logger = tlogger.get('tinybot.webapi')
 
+# parts of the descriptions of the errors telling that a file_id can not be used
+FILE_ID_ERRORS = ('file identifier', 'wrong file', 'file_id', 'file reference', 'file_reference')
+
 
 class TelegramAPI:
     """
@@ -27,18 +42,39 @@ class TelegramAPI:
     and useless messages. 
     """
 
+    max_downloads = 8
+    """Maximum number of files downloaded at the same time, the rest wait for their turn"""
+
+    download_chunk_size = 64 * 1024
+    """Default size of the chunks files are downloaded with"""
+
     def __init_subclass__(cls):
         cls.__static_init__()
 
-    def __init__(self, session, token):
+    def __init__(self, session, token, limiter=None, codec=None, file_cache=None, api_url=None, metrics=None,
+                 response_cache=None):
         """
         :param session: aihttp client session to be used for making requests
         :param token: the token for the Telegram Bot API
+        :param limiter: optional RateLimiter to keep the requests within Telegram limits
+        :param codec: JSON codec for request and response bodies, defaults to the fastest one installed
+        :param file_cache: optional FileIdCache, so that files sent again are sent by their file_id
+        :param api_url: base url of the Bot API server, Telegram one by default.
+        Useful with a local Bot API server, or with the fake one from `tinybot.bench.fakeapi`
+        :param metrics: optional tinybot.metrics.Metrics the latency and the errors of the calls are recorded to
+        :param response_cache: optional tinybot.responsecache.ResponseCache for the results of the methods which only read
         """
         self.__session = session
         self.__token = token
-        self.__url = 'https://api.telegram.org/bot%s/' % token
-        self.__file_url = 'https://api.telegram.org/file/bot%s/' % token
+        self.__limiter = limiter
+        self.__codec = codec or default_codec()
+        self.__file_cache = file_cache
+        self.__downloads = None
+        self.__metrics = metrics
+        self.__response_cache = response_cache
+        self.__api_url = (api_url or 'https://api.telegram.org').rstrip('/')
+        self.__url = '%s/bot%s/' % (self.__api_url, token)
+        self.__file_url = '%s/file/bot%s/' % (self.__api_url, token)
 
     @property
     def token(self):
@@ -48,19 +84,56 @@ class TelegramAPI:
     def session(self):
         return self.__session
 
+    @property
+    def limiter(self):
+        return self.__limiter
+
+    @property
+    def codec(self):
+        return self.__codec
+
+    @property
+    def api_url(self):
+        return self.__api_url
+
+    @property
+    def file_cache(self):
+        return self.__file_cache
+
+    @property
+    def metrics(self):
+        return self.__metrics
+
+    @property
+    def response_cache(self):
+        return self.__response_cache
+
     def request(self, method, **kwargs):
         """
         Send the request with given method and kwargs as JSON or URL query
         arguments (query is used when files are sent).
 
-        If any value in kwargs at any nesting level is an instance of IOBase
+        If any value in kwargs at any nesting level is a file (see InputFile,
+        all of the sources it wraps are recognized without wrapping them)
         then the request is sent as multipart/form-data (and the rest of the
         args as part URL query instead of JSON body) with that value attached
         as file and it's entry in kwargs replaced by 'attach://name' as
         Telegram understands it.
         Name is either choosen sequentially (like 'file_0', 'file_1', and so
-        on) or instead of a pure IOBase file parameter can be specified as a
-        tuple (str, IOBase) for custom file name.
+        on) or instead of a pure file parameter can be specified as a
+        tuple (str, file) for custom file name.
+
+        If the API has a rate limiter, the request waits for it first, and
+        when Telegram answers with a flood limit error the request is
+        repeated after the time Telegram asked to wait.
+
+        If the API has a file cache, files given as top level arguments are
+        looked up in it by their content, and the ones which were sent before
+        are replaced by their file_id. After a file is sent, its file_id is
+        taken from the field of the resulting message named as the argument.
+
+        If the API has a response cache, calls of the methods it caches return the
+        cached result while it is fresh, and concurrent identical calls are sent once.
         """
 
         async def coroutine():
@@ -74,14 +147,14 @@ class TelegramAPI:
                         return {k: rec(v) for k, v in v.items()}
 
                     nonlocal fs, idx
-                    if isinstance(v, tuple) and len(v) == 2 and isinstance(v[1], IOBase):
+                    if isinstance(v, tuple) and len(v) == 2 and is_file(v[1]):
                         name = str(v[0])
-                        fs[name] = v[1]
+                        fs[name] = InputFile(v[1], name)
                         return 'attach://' + name
-                    if isinstance(v, IOBase):
+                    if is_file(v):
                         name = 'file_' + str(idx)
                         idx += 1
-                        fs[name] = v
+                        fs[name] = v if isinstance(v, InputFile) else InputFile(v)
                         return 'attach://' + name
                     return v
 
@@ -89,21 +162,128 @@ class TelegramAPI:
 
             args, files = extract_files(kwargs)
 
+            send_files = send_cached if self.__file_cache is not None and files else send_limited
+
+            metrics = self.__metrics
+            if metrics is None:
+                return await send_files(args, files)
+
+            start = perf_counter()
+            try:
+                result = await send_files(args, files)
+            except Exception as e:
+                code = e.code if isinstance(e, RequestError) and e.code is not None else type(e).__name__
+                metrics.observe_request(method, perf_counter() - start, code)
+                raise
+            metrics.observe_request(method, perf_counter() - start)
+            return result
+
+        async def send_cached(args, files):
+            # only the files given as top level arguments can be found in the result
+            fields = {v[9:]: k for k, v in args.items() if isinstance(v, str) and v.startswith('attach://')}
+            keys = await get_event_loop().run_in_executor(
+                None, lambda: {n: content_key(files[n]) for n in fields if n in files})
+
+            cache = self.__file_cache
+            cached = {}
+            for n, key in keys.items():
+                file_id = cache.get(key) if key is not None else None
+                if file_id is not None:
+                    cached[n] = file_id
+
+            if cached:
+                uploaded = {n: f for n, f in files.items() if n not in cached}
+                cached_args = {k: cached.get(v[9:], v) if isinstance(v, str) and v.startswith('attach://') else v
+                               for k, v in args.items()}
+                try:
+                    result = await send_limited(cached_args, uploaded)
+                except RequestError as e:
+                    # other errors, such as 'chat not found', would fail the upload just the same
+                    if e.code != 400 or not any(s in e.args[0].lower() for s in FILE_ID_ERRORS):
+                        raise
+                    # file_id might have expired or be of some other bot, so upload the files once again
+                    logger.info('failed to send cached files calling %s, uploading them instead', method)
+                    for n in cached:
+                        cache.discard(keys[n])
+                    return await send_cached(args, files)
+            else:
+                uploaded = files
+                result = await send_limited(args, files)
+
+            for n in uploaded:
+                key = keys.get(n)
+                if key is None:
+                    continue
+                file_id = find_file_id(result, fields[n])
+                if file_id is not None:
+                    cache.put(key, file_id)
+            return result
+
+        async def send_limited(args, files):
             log = method not in self.trace_methods
 
             if log:
                 logger.debug('calling method %s %s', method, args)
 
+            limiter = self.__limiter
+            # the calls which do not send messages are not counted, and their flood limits block all of the calls
+            chat_id = args.get('chat_id') if limiter and limiter.limits(method) else None
+            positions = {n: f.file.tell() for n, f in files.items() if isinstance(f.file, IOBase) and f.reusable}
+
+            retries = 0
+            while True:
+                if limiter:
+                    await limiter.acquire(chat_id)
+                try:
+                    return await send(args, files, log)
+                except RequestError as e:
+                    if not limiter or e.retry_after is None or retries >= limiter.max_retries \
+                            or not all(f.reusable for f in files.values()):
+                        raise
+                    logger.info('hit flood limit calling %s, retrying in %s seconds', method, e.retry_after)
+                    limiter.block(e.retry_after, chat_id)
+                    retries += 1
+                    if self.__metrics is not None:
+                        self.__metrics.count_retry(method)
+                    for n, pos in positions.items():
+                        files[n].file.seek(pos)
+
+        def find_file_id(result, field):
+            if not isinstance(result, DynamicDictObject):
+                return None
+            file = result.get(field)
+            # photos come as a list of sizes, the biggest one being the last
+            if isinstance(file, DynamicDictObject) and isinstance(file.unwrap(), list):
+                file = file.get(-1) if file.unwrap() else None
+            if not isinstance(file, DynamicDictObject) or 'file_id' not in file:
+                return None
+            return file.file_id
+
+        async def send(args, files, log):
+            codec = self.__codec
             if files:
-                query = urlencode({k: json.dumps(v) if isinstance(v, (list, dict)) else str(v) for k, v in args.items()})
+                query = urlencode({k: codec.dumps(v).decode('utf-8') if isinstance(v, (list, dict)) else str(v)
+                                   for k, v in args.items()})
                 writer = MultipartWriter('form-data')
-                for n, file in files.items():
-                    writer.append(file).set_content_disposition('attachment', filename=n)
-                response = await self.__session.post(self.__url + method + '?' + query, data=writer)
+                opened = []
+                try:
+                    for n, file in files.items():
+                        part = file.payload(opened)
+                        part.set_content_disposition('form-data', name=n, filename=file.filename or n)
+                        writer.append_payload(part)
+                    response = await self.__session.post(self.__url + method + '?' + query, data=writer)
+                finally:
+                    for f in opened:
+                        f.close()
             else:
-                response = await self.__session.post(self.__url + method, json=args)
+                response = await self.__session.post(self.__url + method, data=codec.dumps(args),
+                                                     headers={'Content-Type': 'application/json'})
 
-            data = DynamicDictObject(await response.json())
+            body = await response.read()
+            try:
+                data = DynamicDictObject(codec.loads(body))
+            except ValueError:
+                raise RequestError('bad response with status %s calling \'%s\'' % (response.status, method)) from None
 
             if log:
                 logger.debug('received answer %s', data)
@@ -112,18 +292,65 @@ class TelegramAPI:
                 if data.ok and 'result' in data:
                     return data.result
                 if 'description' in data:
-                    raise RequestError('server error calling \'%s\': %s' % (method, data.description))
+                    raise RequestError('server error calling \'%s\': %s' % (method, data.description),
+                                       data.get('error_code'), data.get('parameters'))
             raise RequestError('bad response: %s' % data)
 
-        c = coroutine()
+        cache = self.__response_cache
+        c = cache.fetch(method, kwargs, coroutine) if cache is not None else coroutine()
         c.__name__ = method
         c.__qualname__ = f'TelegramAPI.{method}'
         return c
 
+    async def iter_download(self, file_id, chunk_size=None):
+        """
+        Async iterator over the content of the file with given file_id, in chunks
+        of at most given size. At most `max_downloads` files are downloaded at the same time.
+        """
+        file = await self.getFile(file_id=file_id)
+        if self.__downloads is None:
+            self.__downloads = Semaphore(self.max_downloads)
+        async with self.__downloads:
+            async with self.__session.get(self.__file_url + file.file_path) as response:
+                if response.status != 200:
+                    raise RequestError('failed to download file \'%s\', status %s' % (file_id, response.status))
+                async for chunk in response.content.iter_chunked(chunk_size or self.download_chunk_size):
+                    yield chunk
+
+    async def download_to(self, file_id, target, chunk_size=None):
+        """
+        Downloads the file with given file_id into given path or writable file object
+        chunk by chunk, so the file is never fully kept in memory. Returns DownloadStats.
+        Chunks are written to a path in the default executor, while the next chunk is downloaded,
+        file objects are written to on the event loop, so they should be fast ones like BytesIO
+        """
+        start, size = monotonic(), 0
+        if isinstance(target, (str, PathLike)):
+            loop = get_event_loop()
+            f = await loop.run_in_executor(None, open, target, 'wb')
+            writing = None
+            try:
+                async for chunk in self.iter_download(file_id, chunk_size):
+                    if writing is not None:
+                        await writing
+                    writing = loop.run_in_executor(None, f.write, chunk)
+                    size += len(chunk)
+                if writing is not None:
+                    await writing
+            finally:
+                if writing is not None and not writing.done():
+                    # the file is closed only after the last write is finished
+                    await wait([writing])
+                await loop.run_in_executor(None, f.close)
+        else:
+            async for chunk in self.iter_download(file_id, chunk_size):
+                target.write(chunk)
+                size += len(chunk)
+        return DownloadStats(size, monotonic() - start)
+
     async def download(self, file_id):
         """Small util function to get the file content from given file_id."""
-        file = await self.getFile(file_id=file_id)
-        return await self.__session.get(self.__file_url + file.file_path).read()
+        return b''.join([chunk async for chunk in self.iter_download(file_id)])
 
     def __getattr__(self, item):
         return TelegramAPI.Method(self, item)
@@ -142,63 +369,219 @@ class TelegramAPI:
 
 
 class BlockingTelegramAPI(TelegramAPI):
+    """
+    API for sync handlers run in other threads, each call is made on the event loop of
+    the wrapped API and waited for. In the `deferred` context, calls return futures instead
+    """
 
     @classmethod
     def __static_init__(cls):
         method_type = type(cls.__init__)
         for n in dir(TelegramAPI):
             func = getattr(TelegramAPI, n)
-            if n.startswith('_') or type(func) != method_type:
+            if n.startswith('_') or type(func) != method_type or isasyncgenfunction(func):
                 continue
 
             def blocking(f):
-                return lambda self, *args, **kwargs: \
-                    run_coroutine_threadsafe(f(self, *args, **kwargs), self.__loop).result()
+                def call(self, *args, **kwargs):
+                    future = run_coroutine_threadsafe(f(self.__api, *args, **kwargs), self.__loop)
+                    pending = getattr(self.__local, 'pending', None)
+                    if pending is None:
+                        return future.result()
+                    pending.append(future)
+                    return future
+
+                return call
 
             setattr(cls, n, blocking(func))
 
     def __init__(self, api, loop):
-        super().__init__(api.session, api.token)
+        super().__init__(api.session, api.token, api.limiter, api.codec, api.file_cache, api.api_url,
+                         api.metrics, api.response_cache)
+        self.__api = api
         self.__loop = loop
+        self.__local = local()
+
+    @contextmanager
+    def deferred(self, wait=True):
+        """
+        Within this context, the calls made by the current thread return
+        concurrent.futures.Future right away instead of waiting for the result,
+        so that independent calls are made at the same time. Calls whose order
+        matters should wait for the result of the previous one with `.result()`.
+
+        On exit, it waits for all of the calls made within it and raises the
+        first of their errors. With `wait=False` it does not wait for them,
+        the errors are logged instead. If the context exits with an error,
+        the calls which are not done yet are cancelled.
+        """
+        outer = getattr(self.__local, 'pending', None)
+        pending = self.__local.pending = []
+        try:
+            yield pending
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            self.__local.pending = outer
+
+        if not wait:
+            for future in pending:
+                future.add_done_callback(log_deferred_error)
+            return
+        futures.wait(pending)
+        for future in pending:
+            if not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+
+
+def log_deferred_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning('deferred call failed, %s', future.exception())
+
+
+class InputFile:
+    """
+    A file to be sent, any of these sources can be used:
+     - a path (pathlib.Path, not a str), the file is opened and streamed from disk
+     - bytes, bytearray, memoryview or mmap, sent as is without copying
+     - a file object (IOBase), read in chunks
+     - an async iterable of bytes, e.g. an async generator making the file on the fly
+
+    The sources can be given as request arguments directly, this class is
+    only needed to give the file a name or an explicit content type
+    (which is guessed from the name otherwise), or a key under which the
+    file is put into the file_id cache instead of the hash of its content.
+    """
+
+    __slots__ = ('file', 'name', 'content_type', 'key')
+
+    def __init__(self, file, name=None, content_type=None, key=None):
+        self.file = file
+        self.name = name
+        self.content_type = content_type
+        self.key = key
+
+    @property
+    def filename(self):
+        if self.name is not None:
+            return self.name
+        if isinstance(self.file, PurePath):
+            return self.file.name
+        name = getattr(self.file, 'name', None)
+        return basename(name) if isinstance(name, str) else None
+
+    @property
+    def reusable(self):
+        """Whether the file can be sent again, async iterables and unseekable file objects can not"""
+        if isinstance(self.file, IOBase):
+            return self.file.seekable()
+        return not hasattr(self.file, '__aiter__')
+
+    def payload(self, opened):
+        """Makes an aiohttp payload for the file, the files it opens are added to `opened`"""
+        filename = self.filename
+        content_type = self.content_type or (filename and guess_type(filename)[0]) or 'application/octet-stream'
+        file = self.file
+        if isinstance(file, PurePath):
+            file = open(file, 'rb')
+            opened.append(file)
+        elif isinstance(file, mmap):
+            file = memoryview(file)
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            return payload.BytesPayload(file, content_type=content_type)
+        if hasattr(file, '__aiter__'):
+            return payload.AsyncIterablePayload(file, content_type=content_type)
+        return payload.get_payload(file, content_type=content_type)
+
+
+def is_file(v):
+    return isinstance(v, (InputFile, IOBase, PurePath, bytes, bytearray, memoryview, mmap)) or hasattr(v, '__aiter__')
+
+
+class DownloadStats(namedtuple('DownloadStats', 'size seconds')):
+    """Size in bytes and duration of a finished download"""
+
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        return self.size / self.seconds if self.seconds else float('inf')
 
 
 class DynamicDictObject:
     """
     A recursive view of dict/list-like structure with __getattr__'s and __getitem__'s
     When trying to get a nonexistent item raises NoSuchElementException.
+
+    Views only keep a link to their parent and the key they were got by,
+    the path used in error messages is built only when an error is raised.
     """
 
-    def __new__(cls, peer, path=''):
+    __slots__ = ('__peer', '__parent', '__key', '__children')
+
+    cache_children = False
+    """
+    Whether child views are remembered, so that repeated access to the same
+    field does not create new objects. Assumes the viewed structure is not mutated.
+    Off by default, as handlers usually get each field of an update once, and then
+    the cache only costs (see `tinybot.bench.dynamic`). Only str and int keys are cached
+    """
+
+    def __new__(cls, peer, parent=None, key=None):
         if not isinstance(peer, (dict, list)):
             return peer
         return super().__new__(cls)
 
-    def __init__(self, peer, path=''):
-        self.__peer, self.__path = peer, path
+    def __init__(self, peer, parent=None, key=None):
+        # __new__ returns views as they are, which are then initialized again
+        if peer is self:
+            return
+        self.__peer, self.__parent, self.__key, self.__children = peer, parent, key, None
 
     def with_root(self, path):
-        self.__path = '.' + path
-        return self
+        """Returns the same view, but with given name as the root of error paths"""
+        view = object.__new__(DynamicDictObject)
+        view.__peer, view.__parent, view.__key, view.__children = _peer(self), None, path, None
+        return view
 
     def items(self):
-        peer = self.__peer
+        peer = _peer(self)
         if not isinstance(peer, dict):
-            raise DynamicTypeError(f'expected an object at {self.__path[1:]}, but it was '
+            raise DynamicTypeError(f'expected an object at \'{_path(self)}\', but it was '
                                    f'\'{type(peer).__name__}\'')
         return map(lambda k: (k, self[k]), peer)
 
+    def unwrap(self):
+        """Returns the viewed dict or list itself"""
+        return _peer(self)
+
     def get(self, item):
+        peer = _peer(self)
+        if isinstance(peer, dict) and item not in peer:
+            return None
         try:
             return self[item]
         except NoSuchElementError:
             return None
 
-    def __getattr__(self, item):
-        peer = self.__peer
+    def __getattribute__(self, item):
+        # fields are looked up before the attributes of the view itself, as
+        # a normal lookup failing over to __getattr__ is way more expensive
+        if item in _own_attributes or item[0] == '_':
+            try:
+                return _getattribute(self, item)
+            except AttributeError:
+                pass
+        children = _children(self)
+        if children is not None:
+            child = children.get(item)
+            if child is not None:
+                return child
+        peer = _peer(self)
         if not isinstance(peer, dict):
-            raise DynamicTypeError(f'expected an object at \'{self.__path[1:]}\', but it was '
+            raise DynamicTypeError(f'expected an object at \'{_path(self)}\', but it was '
                                    f'\'{type(peer).__name__}\'')
-        path = f'{self.__path}.{item}'
         try:
             child = peer[item]
             # callables without arguments treated as properties
@@ -206,42 +589,108 @@ class DynamicDictObject:
             while callable(child):
                 child = child()
         except (TypeError, KeyError):
-            raise NoSuchElementError(path[1:]) from None
-        return DynamicDictObject(child, path)
+            raise NoSuchElementError(_path(self, item)) from None
+        if not isinstance(child, (dict, list)):
+            return child
+        return _wrap(self, child, item)
 
     def __getitem__(self, item):
-        if isinstance(item, str) and item.isidentifier():
-            path = f'{self.__path}.{item}'
-        else:
-            path = f'{self.__path}[{repr(item)}]'
-        peer = self.__peer
+        children = _children(self)
+        # slices and such are not cached, they are not even hashable in older pythons
+        if children is not None and type(item) in _cached_keys:
+            child = children.get(item)
+            if child is not None:
+                return child
+        peer = _peer(self)
         try:
             child = peer[item]
         except TypeError:
-            raise DynamicTypeError(f'tried to index \'{type(peer).__name__}\' at {self.__path[1:]} with key of '
+            raise DynamicTypeError(f'tried to index \'{type(peer).__name__}\' at {_path(self)} with key of '
                                    f'type \'{type(item).__name__}\'') from None
         except (KeyError, IndexError):
-            raise NoSuchElementError(path[1:]) from None
-        return DynamicDictObject(child, path)
+            raise NoSuchElementError(_path(self, item)) from None
+        if not isinstance(child, (dict, list)):
+            return child
+        return _wrap(self, child, item)
 
     def __contains__(self, item):
-        if isinstance(self.__peer, dict):
-            return item in self.__peer
+        peer = _peer(self)
+        if isinstance(peer, dict):
+            return item in peer
         return False
 
     def __iter__(self):
-        if isinstance(self.__peer, list):
-            path = self.__path
-            return map(lambda x: DynamicDictObject(x[1], f'{path}[{x[0]}]'), enumerate(self.__peer))
+        peer = _peer(self)
+        if isinstance(peer, list):
+            return map(self.__getitem__, range(len(peer)))
 
-        return iter(self.__peer)
+        return iter(peer)
 
     def __repr__(self):
-        return repr(self.__peer)
+        return repr(_peer(self))
+
+
+_getattribute = object.__getattribute__
+_cached_keys = (str, int)
+_own_attributes = frozenset(n for n in dir(DynamicDictObject) if not n.startswith('_'))
+
+# slot getters, so that the internals do not go through DynamicDictObject.__getattribute__
+_peer = DynamicDictObject._DynamicDictObject__peer.__get__
+_parent = DynamicDictObject._DynamicDictObject__parent.__get__
+_key = DynamicDictObject._DynamicDictObject__key.__get__
+_children = DynamicDictObject._DynamicDictObject__children.__get__
+_set_children = DynamicDictObject._DynamicDictObject__children.__set__
+
+
+def _wrap(parent, child, key):
+    view = object.__new__(DynamicDictObject)
+    view._DynamicDictObject__peer = child
+    view._DynamicDictObject__parent = parent
+    view._DynamicDictObject__key = key
+    view._DynamicDictObject__children = None
+    if DynamicDictObject.cache_children and type(key) in _cached_keys:
+        children = _children(parent)
+        if children is None:
+            children = {}
+            _set_children(parent, children)
+        children[key] = view
+    return view
+
+
+def _path(view, *keys):
+    parts = []
+    while _parent(view) is not None:
+        parts.append(_key(view))
+        view = _parent(view)
+    parts.reverse()
+    parts.extend(keys)
+
+    path = _key(view) or ''
+    for key in parts:
+        if isinstance(key, str) and key.isidentifier():
+            path = f'{path}.{key}' if path else key
+        else:
+            path = f'{path}[{key!r}]'
+    return path
 
 
 class RequestError(Exception):
-    pass
+
+    def __init__(self, message, code=None, parameters=None):
+        super().__init__(message)
+        self.code = code
+        """Telegram error code if the server answered with one"""
+        self.parameters = DynamicDictObject(parameters)
+        """ResponseParameters object if the server answered with one"""
+
+    def __reduce__(self):
+        parameters = self.parameters.unwrap() if self.parameters is not None else None
+        return RequestError, (self.args[0], self.code, parameters)
+
+    @property
+    def retry_after(self):
+        """Number of seconds to wait before repeating the request after a flood limit error"""
+        return self.parameters.get('retry_after') if self.parameters is not None else None
 
 
 class NoSuchElementError(Exception):
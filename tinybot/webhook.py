@@ -0,0 +1,167 @@
+import asyncio
+import ssl
+
+from aiohttp import web
+from aiohttp.abc import AbstractAccessLogger
+
+import tinybot.logger as tlogger
+from tinybot.webapi import DynamicDictObject
+
+__all__ = ('AdmissionControl', 'create_update_handler', 'create_webhook_app', 'create_ssl_context', 'serve_app')
+
+logger = tlogger.get('tinybot.webhook')
+
+
+class AccessLogger(AbstractAccessLogger):
+
+    def log(self, request, response, time):
+        # path is not logged since it contains the token
+        self.logger.debug('%s request answered with %s in %.3fs', request.method, response.status, time)
+
+
+class AdmissionControl:
+    """
+    Decides whether an update delivered to the webhook is accepted. While the
+    dispatcher is saturated, the request waits for a free slot for up to
+    `timeout` seconds and is then rejected, so that Telegram delivers the update
+    again later instead of the bot queueing work it can not keep up with.
+    The number of updates queued is thus bounded by the number of connections Telegram makes.
+
+    It also suggests the `max_connections` for the webhook from what it saw, see `adjust`.
+    """
+
+    def __init__(self, dispatcher, timeout=5, max_connections=40, min_connections=5, connections_limit=100):
+        """
+        :param dispatcher: the dispatcher updates are submitted to
+        :param timeout: seconds a request waits for a free slot before being rejected
+        :param max_connections: initial max_connections of the webhook
+        :param min_connections: lowest max_connections `adjust` suggests
+        :param connections_limit: highest max_connections `adjust` suggests, Telegram allows at most 100
+        """
+        self.__dispatcher = dispatcher
+        self.__timeout = timeout
+        self.max_connections = max_connections
+        self.min_connections = min_connections
+        self.connections_limit = connections_limit
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.__last = (0, 0, 0)
+
+    @property
+    def stats(self):
+        return {'admitted': self.admitted, 'delayed': self.delayed, 'rejected': self.rejected,
+                'max_connections': self.max_connections}
+
+    async def admit(self):
+        """Returns whether the update can be submitted, waiting for the dispatcher if it is saturated"""
+        dispatcher = self.__dispatcher
+        if dispatcher.saturated:
+            self.delayed += 1
+            try:
+                await asyncio.wait_for(dispatcher.wait_ready(), self.__timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+        self.admitted += 1
+        return True
+
+    def adjust(self, handler_latency, latency_target, pending_updates):
+        """
+        Returns the max_connections the webhook should have after the time since the previous call:
+        decreased multiplicatively if updates were rejected or handlers took longer than
+        `latency_target` seconds on average, increased additively if there was no pressure
+        and Telegram has updates waiting to be delivered, and the same otherwise.
+
+        :param handler_latency: mean handler latency since the previous call, None if nothing was handled
+        :param latency_target: mean handler latency above which the bot is considered overloaded
+        :param pending_updates: pending_update_count of the webhook info
+        """
+        admitted, delayed, rejected = self.admitted, self.delayed, self.rejected
+        last_admitted, last_delayed, last_rejected = self.__last
+        self.__last = (admitted, delayed, rejected)
+
+        current = self.max_connections
+        if rejected > last_rejected or (handler_latency is not None and handler_latency > latency_target):
+            suggested = max(self.min_connections, int(current * 0.7))
+        elif delayed == last_delayed and pending_updates:
+            suggested = min(self.connections_limit, current + 5)
+        else:
+            suggested = current
+        self.max_connections = suggested
+        return suggested
+
+
+def create_update_handler(bot_cls, submit, codec, admission=None):
+    """
+    Creates an aiohttp handler of the update POST requests from Telegram to given bot.
+
+    Each received update is given to `submit`, which should only schedule the
+    handling and return right away, so that Telegram gets its 200 response
+    as soon as possible and can reuse the connection for the next update.
+    The body is decoded from bytes with given JSON codec.
+
+    With an AdmissionControl given, updates it does not admit are answered
+    with 503, which makes Telegram deliver them again later.
+    """
+    headers = {'Server': bot_cls.full_name}
+    rejected_headers = {'Server': bot_cls.full_name, 'Retry-After': '1'}
+
+    async def handle_post(request):
+        try:
+            data = codec.loads(await request.read())
+        except ValueError:
+            logger.warning('received POST request with malformed JSON body')
+            return web.Response(status=400, headers=headers)
+        if admission is not None and not await admission.admit():
+            logger.debug('rejected update %s, handlers are falling behind', data.get('update_id'))
+            return web.Response(status=503, headers=rejected_headers)
+        submit(DynamicDictObject(data))
+        return web.Response(headers=headers)
+
+    return handle_post
+
+
+def create_webhook_app(handlers):
+    """
+    Creates an aiohttp application which accepts update POST requests from
+    Telegram at '/<token>' path (as set by `Bot.update_webhook`), and passes them to
+    the handler for that token in given dict, see `create_update_handler`.
+    One application can thus serve many bots at one port
+    """
+
+    async def handle_post(request):
+        handler = handlers.get(request.match_info['token'])
+        if handler is None:
+            logger.warning('received POST request most likely not from Telegram servers')
+            return web.Response(status=404)
+        return await handler(request)
+
+    app = web.Application()
+    app.router.add_post('/{token}', handle_post)
+    return app
+
+
+def create_ssl_context(cert_path, key_path):
+    """Creates a server SSL context with given certificate and key, TLS 1.2 at least"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+async def serve_app(app, port, reuse_port=False, ssl_context=None):
+    """
+    Serves given aiohttp application on the current event loop until cancelled.
+    With `reuse_port` many processes can listen at the same port, and the kernel balances connections between them.
+    With `ssl_context` it is served over HTTPS
+    """
+    runner = web.AppRunner(app, access_log=logger, access_log_class=AccessLogger)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, port=port, reuse_port=reuse_port, ssl_context=ssl_context).start()
+        logger.info('started webhook server at port %s%s', port, ' with TLS' if ssl_context else '')
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
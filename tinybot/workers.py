@@ -0,0 +1,44 @@
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+import tinybot.logger as tlogger
+
+__all__ = ('supervise',)
+
+logger = tlogger.get('tinybot.workers')
+
+
+def supervise(target, count, args=(), restart_delay=1):
+    """
+    Forks `count` processes running `target(index, *args)` and restarts the
+    ones that die until interrupted. Processes which die too soon after being
+    started are restarted after a delay, so a broken worker does not spin.
+
+    Fork is used explicitly so that the bot class and everything set on it at
+    runtime (such as the token from the command line) is there in the workers.
+    """
+    context = multiprocessing.get_context('fork')
+
+    def start(index):
+        process = context.Process(target=target, args=(index, *args), name=f'tinybot-worker-{index}')
+        process.start()
+        logger.info('started worker %s with pid %s', index, process.pid)
+        return process, time.monotonic()
+
+    workers = {i: start(i) for i in range(count)}
+    try:
+        while True:
+            wait([process.sentinel for process, _ in workers.values()])
+            for index, (process, started) in list(workers.items()):
+                if process.is_alive():
+                    continue
+                logger.warning('worker %s with pid %s died with exit code %s', index, process.pid, process.exitcode)
+                if time.monotonic() - started < restart_delay:
+                    time.sleep(restart_delay)
+                workers[index] = start(index)
+    finally:
+        for process, _ in workers.values():
+            process.terminate()
+        for process, _ in workers.values():
+            process.join()